@@ -51,6 +51,7 @@ setup(
     tests_require=TESTS_REQUIRE,
     install_requires=[
         'BTrees >= 4.3.2',  # permissive get()
+        'futures; python_version == "2.7"', # concurrent.futures
         # test dependencies have this at >= 5.6.0; for consistency,
         # do the same in regular deps.
         'ZODB >= 5.6.0',
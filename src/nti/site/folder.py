@@ -11,6 +11,8 @@ __docformat__ = "restructuredtext en"
 
 logger = __import__('logging').getLogger(__name__)
 
+from BTrees import family64
+
 from zope import interface
 
 from zope.site.folder import Folder
@@ -19,6 +21,10 @@ from .site import BTreeLocalSiteManager
 
 from ZODB.POSException import ConnectionStateError
 
+from transaction.interfaces import NoTransaction
+
+from persistent.list import PersistentList
+
 from nti.site.interfaces import IHostSitesFolder
 from nti.site.interfaces import IHostPolicyFolder
 from nti.site.interfaces import IHostPolicySiteManager
@@ -27,21 +33,263 @@ from nti.site.interfaces import IHostPolicySiteManager
 class HostSitesFolder(Folder):
     """
     Simple container implementation for named host sites.
+
+    .. versionchanged:: 3.1.0
+       Cache the top-down ordering of the contained sites. Removing a
+       site, or changing the bases of a contained site's site manager,
+       discards the cache; adding a site makes it out of date. See
+       :meth:`getOrderedSiteNames`.
+
+    .. versionchanged:: 3.1.0
+       Maintain an index from each site to the sites that are its
+       direct children. See :meth:`indexSite`.
+
+    .. versionchanged:: 3.1.0
+       Add :meth:`getHostSite`.
+
+    .. versionchanged:: 3.1.0
+       Add :meth:`getJobCheckpoint` and :meth:`removeJobCheckpoint`
+       to examine the job checkpoints of the contained sites.
+
+    .. versionchanged:: 3.1.0
+       Add :attr:`lazySiteCreation`.
     """
     lastSynchronized = 0
 
+    #: If true, :func:`nti.site.hostpolicy.synchronize_host_policies`
+    #: does not create missing sites. Instead,
+    #: :func:`nti.site.site.get_site_for_site_names` creates each one
+    #: the first time it is used in a transaction that can write.
+    lazySiteCreation = False
+
+    #: The names of the contained sites in top-down order, or None if
+    #: that order must be computed again. It is stored by the functions
+    #: that create sites, such as
+    #: :func:`nti.site.hostpolicy.synchronize_host_policies`, never by
+    #: readers, who only remember an order they had to compute until the
+    #: end of their transaction. This is a separate persistent object so
+    #: that it is not loaded every time this folder is. Use
+    #: :meth:`getOrderedSiteNames` to read it.
+    orderedSiteNames = None
+
+    # Lazily created BTrees mapping a site name to the name of its parent
+    # site, and a parent site name to a TreeSet of child site names.
+    _siteParents = None
+    _siteChildren = None
+
+    # A pair (transaction, dict) of things remembered until the end
+    # of that transaction: the results of getHostSite, and the site
+    # order computed by a reader. The sites are stored in a separate
+    # BTree, so we are not invalidated when another connection adds or
+    # removes one; a new transaction sees those changes.
+    _v_transactionCache = None
+
+    # Volatile map from the name of a site that doesn't exist yet to
+    # the names of the sites that would be its ancestors, nearest first.
+    # This only depends on the global components.
+    _v_lazySiteAncestors = None
+
     def __repr__(self):
         try:
             return super(HostSitesFolder, self).__repr__()
         except ConnectionStateError:
             return object.__repr__(self)
 
+    def setOrderedSiteNames(self, names):
+        self.orderedSiteNames = PersistentList(names)
+        return self.orderedSiteNames
+
+    def getOrderedSiteNames(self):
+        """
+        Return :attr:`orderedSiteNames` if it is up to date, otherwise
+        None.
+
+        Adding a site doesn't change this folder (so that sites can be
+        added concurrently without conflicting here); instead, a stored
+        order that doesn't have as many names as there are sites is out
+        of date.
+        """
+        names = self.orderedSiteNames
+        if names is not None and len(names) != len(self):
+            return None
+        return names
+
+    def invalidateSiteOrder(self):
+        self._v_transactionCache = None
+        # Don't needlessly mark ourself as changed.
+        if self.orderedSiteNames is not None:
+            self.orderedSiteNames = None
+
+    def _getTransactionCache(self):
+        """
+        Return a dict that is kept until the end of the current
+        transaction of our connection, or until a site is added or
+        removed, or None if we are not in a transaction.
+        """
+        transaction_manager = getattr(self._p_jar, 'transaction_manager', None)
+        if transaction_manager is None:
+            return None
+        try:
+            tx = transaction_manager.get()
+        except NoTransaction:
+            return None
+        # Loading our state, if we are a ghost, discards volatile
+        # attributes, so do that first.
+        self._p_activate()
+        cache = self._v_transactionCache
+        if cache is None or cache[0] is not tx:
+            cache = self._v_transactionCache = (tx, {})
+        return cache[1]
+
+    def getHostSite(self, name):
+        """
+        Like ``self[name]``, but remembers the result for the next call
+        made in the same transaction.
+        """
+        cache = self._getTransactionCache()
+        if cache is None:
+            return self[name]
+        key = ('site', name)
+        try:
+            return cache[key]
+        except KeyError:
+            site = cache[key] = self[name]
+            return site
+
+    def indexSite(self, name, parent_name=None):
+        """
+        Record that the site named *parent_name* is the direct parent
+        of the site named *name*. If *parent_name* is None, the site has
+        no parent host site.
+
+        The first call creates the index, even for a site with no
+        parent, so that a hierarchy with no nesting is indexed too.
+
+        :return: Whether the index changed.
+        """
+        created = False
+        if self._siteParents is None:
+            self._siteParents = family64.OO.BTree()
+            self._siteChildren = family64.OO.BTree()
+            created = True
+
+        old_parent_name = self._siteParents.get(name)
+        if old_parent_name == parent_name:
+            return created
+        if old_parent_name is not None:
+            self._siteChildren[old_parent_name].remove(name)
+        if parent_name is None:
+            del self._siteParents[name]
+        else:
+            self._siteParents[name] = parent_name
+            children = self._siteChildren.get(parent_name)
+            if children is None:
+                children = self._siteChildren[parent_name] = family64.OO.TreeSet()
+            children.add(name)
+        return True
+
+    def unindexSite(self, name):
+        """
+        Remove the site named *name* from the index. Any children it
+        had are left without a parent.
+        """
+        if self._siteParents is None:
+            return
+        self.indexSite(name, None)
+        for child in self._siteChildren.pop(name, ()):
+            del self._siteParents[child]
+
+    def hasSiteIndex(self):
+        """
+        Has :meth:`indexSite` been called?
+        Databases created before the index existed don't have it until
+        :func:`nti.site.hostpolicy.synchronize_host_policies` runs.
+        """
+        return self._siteParents is not None
+
+    def getParentSiteName(self, name):
+        """
+        Return the name of the indexed parent of the site named *name*, or None.
+        """
+        return self._siteParents.get(name) if self._siteParents is not None else None
+
+    def getChildSiteNames(self, name):
+        """
+        Return a sorted tuple of the names of the indexed direct children
+        of the site named *name*.
+        """
+        children = self._siteChildren.get(name) if self._siteChildren is not None else None
+        return tuple(children) if children else ()
+
+    def getJobCheckpoint(self, name):
+        """
+        Return a list, in name order, of the names of the contained
+        sites that have reached the job checkpoint called *name* (see
+        :meth:`HostPolicyFolder.addJobCheckpoint`).
+
+        This loads every site.
+        """
+        return [site_name for site_name, site in self.items()
+                if site.hasJobCheckpoint(name)]
+
+    def removeJobCheckpoint(self, name):
+        """
+        Remove the job checkpoint called *name* from every contained
+        site that reached it.
+
+        This loads every site.
+        """
+        for site in self.values():
+            site.removeJobCheckpoint(name)
+
+    def _setitemf(self, key, value):
+        super(HostSitesFolder, self)._setitemf(key, value)
+        # Leave the stored order; its length shows it's out of date.
+        self._v_transactionCache = None
+
+    def __delitem__(self, key):
+        # Before the removal events are sent.
+        self.invalidateSiteOrder()
+        super(HostSitesFolder, self).__delitem__(key)
+
 @interface.implementer(IHostPolicyFolder)
 class HostPolicyFolder(Folder):
     """
     Simple container implementation for the named host site.
+
+    .. versionchanged:: 3.1.0
+       Keep the names of the job checkpoints the site has reached.
+       See :meth:`addJobCheckpoint`.
     """
 
+    # Lazily created TreeSet of the names of the job checkpoints this
+    # site has reached. This is kept in each site, not in the
+    # HostSitesFolder, so that jobs committing in different sites at
+    # the same time don't conflict.
+    _jobCheckpoints = None
+
+    def addJobCheckpoint(self, name):
+        """
+        Record that the job with the checkpoint called *name* has been
+        completed in this site.
+        """
+        if self._jobCheckpoints is None:
+            self._jobCheckpoints = family64.OO.TreeSet()
+        self._jobCheckpoints.add(name)
+
+    def hasJobCheckpoint(self, name):
+        """
+        Has :meth:`addJobCheckpoint` been called with *name*?
+        """
+        return self._jobCheckpoints is not None and name in self._jobCheckpoints
+
+    def removeJobCheckpoint(self, name):
+        """
+        Forget the job checkpoint called *name*, if it was reached.
+        """
+        if self.hasJobCheckpoint(name):
+            self._jobCheckpoints.remove(name)
+
     def __str__(self): # pragma: no cover
         return 'HostPolicyFolder(%s)' % self.__name__
 
@@ -51,6 +299,13 @@ class HostPolicyFolder(Folder):
 @interface.implementer(IHostPolicySiteManager)
 class HostPolicySiteManager(BTreeLocalSiteManager):
 
+    def _setBases(self, bases):
+        super(HostPolicySiteManager, self)._setBases(bases)
+        # We may have moved within the host site hierarchy.
+        sites = getattr(getattr(self, '__parent__', None), '__parent__', None)
+        if IHostSitesFolder.providedBy(sites):
+            sites.invalidateSiteOrder()
+
     def __repr__(self):
         try:
             return super(HostPolicySiteManager, self).__repr__()
@@ -13,8 +13,21 @@ __docformat__ = "restructuredtext en"
 
 logger = __import__('logging').getLogger(__name__)
 
+import csv
+import importlib
+import io
+import json
+import zlib
+
+from collections import deque
+from collections import namedtuple
+
+from six import PY2
 from six import string_types
 
+import transaction
+from transaction.interfaces import NoTransaction
+
 from zope import lifecycleevent
 from zope import component
 from zope import interface
@@ -22,9 +35,16 @@ from zope import interface
 from zope.component.hooks import site as current_site
 from zope.component.interfaces import ISite
 
+from zope.container.contained import containedEvent
+from zope.container.contained import notifyContainerModified
+
+from zope.event import notify
+
 from zope.interface import ro
 from zope.interface.interfaces import IComponents
+from zope.interface.interfaces import Registered
 from zope.interface.interfaces import ComponentLookupError
+from zope.interface.registry import UtilityRegistration
 
 from zope.traversing.interfaces import IEtcNamespace
 
@@ -36,11 +56,14 @@ from .folder import HostPolicyFolder
 from .folder import HostPolicySiteManager
 from .folder import HostSitesFolder
 from .interfaces import IMainApplicationFolder
+from .interfaces import IHostPolicySiteManager
 from .site import BTreeLocalSiteManager
+from .transient import HostSiteManager
+from .transient import TrivialSite
 
 text_type = str if bytes is not str else unicode
 
-def synchronize_host_policies():
+def synchronize_host_policies(lazy=None):
     """
     Called within a transaction with a site being the current application
     site, find any :mod:`z3c.baseregistry` components that
@@ -48,6 +71,14 @@ def synchronize_host_policies():
 
     As a prerequisite, :func:`install_sites_folder` must have been done, and
     we must be in that site.
+
+    .. versionchanged:: 3.1.0
+       Record the parent of each site, new or existing, in the
+       child index of the host sites folder.
+    .. versionchanged:: 3.1.0
+       Add the *lazy* argument. If given, it sets
+       :attr:`.HostSitesFolder.lazySiteCreation`. When that is true,
+       missing sites are not created here; see :func:`get_lazy_host_site`.
     """
 
     # TODO: We will ultimately need to deal with removing and renaming
@@ -78,7 +109,7 @@ def synchronize_host_policies():
     #   PS1.__bases__ = (S1, DS)
     #   PS2.__bases__ = (S2, PS1)
 
-    sites = component.getUtility(IEtcNamespace, name='hostsites')
+    sites = get_host_sites_folder()
     ds_folder = sites.__parent__
     assert IMainApplicationFolder.providedBy(ds_folder)
 
@@ -101,35 +132,155 @@ def synchronize_host_policies():
     # towards the root; the first one we put in the DB gets the DS as its
     # base, otherwise it gets the previous one we put in.
 
+    if lazy is not None:
+        sites.lazySiteCreation = lazy
+    create = not sites.lazySiteCreation
+
     for site_ro in site_ros:
-        site_ro = reversed(site_ro)
-
-        secondary_comps = ds_site_manager
-        for comps in site_ro:
-            name = comps.__name__
-            logger.debug("Checking host policy for site %s", name)
-            if name.endswith('base') or name.startswith('base'):
-                # The GSM or the base global objects
-                # TODO: better way to do this...marker interface?
-                continue # pragma: no cover
-            if name in sites:
-                logger.debug("Host policy for %s already in place", name)
-                # Ok, we've already put one in for this level.
-                # We need to make it our next choice going forward
-                secondary_comps = sites[name].getSiteManager()
-            else:
-                # Great, create the site
-                logger.info("Installing site policy %s", name)
-
-                site = HostPolicyFolder()
-                # should fire object created event
-                sites[name] = site
-
-                site_policy = HostPolicySiteManager(site)
-                site_policy.__bases__ = (comps, secondary_comps)
-                # should fire INewLocalSite
-                site.setSiteManager(site_policy)
-                secondary_comps = site_policy
+        _synchronize_host_site_ro(sites, site_ro, ds_site_manager, create)
+    _store_host_site_order(sites)
+
+
+def _synchronize_host_site_ro(sites, site_ro, ds_site_manager, create=True):
+    # Walking the resolution order of one global IComponents from the
+    # top, make sure there is a persistent site for each level. Return
+    # the site manager for the bottom level.
+    site_ro = reversed(site_ro)
+
+    secondary_comps = ds_site_manager
+    parent_name = None
+    for comps in site_ro:
+        name = comps.__name__
+        logger.debug("Checking host policy for site %s", name)
+        if name.endswith('base') or name.startswith('base'):
+            # The GSM or the base global objects
+            # TODO: better way to do this...marker interface?
+            continue # pragma: no cover
+        if name in sites:
+            logger.debug("Host policy for %s already in place", name)
+            # Ok, we've already put one in for this level.
+            # We need to make it our next choice going forward
+            secondary_comps = sites[name].getSiteManager()
+        elif not create:
+            logger.debug("Deferring creation of host policy for %s", name)
+            continue
+        else:
+            # Great, create the site
+            logger.info("Installing site policy %s", name)
+
+            site = HostPolicyFolder()
+            # should fire object created event
+            sites[name] = site
+
+            site_policy = HostPolicySiteManager(site)
+            site_policy.__bases__ = (comps, secondary_comps)
+            # should fire INewLocalSite
+            site.setSiteManager(site_policy)
+            secondary_comps = site_policy
+        sites.indexSite(name, parent_name)
+        parent_name = name
+    return secondary_comps
+
+
+def mark_transaction_side_effect_free(tx):
+    """
+    Record that the transaction *tx* will be aborted rather than
+    committed, so that functions like :func:`get_lazy_host_site` don't
+    make persistent changes in it that would only be thrown away.
+
+    The site job runners do this for side-effect free and read-only
+    jobs.
+
+    .. versionadded:: 3.1.0
+    """
+    tx.set_data(mark_transaction_side_effect_free, True)
+
+
+def _is_writable(obj):
+    # Are we in a transaction whose changes to *obj* can be committed?
+    # (Objects not in a database can always be changed.)
+    jar = getattr(obj, '_p_jar', None)
+    if jar is None:
+        return True
+    if jar.isReadOnly():
+        return False
+    if getattr(jar, 'before', None) is not None:
+        # Historical connections can't write.
+        return False
+    try:
+        tx = jar.transaction_manager.get()
+    except NoTransaction:
+        return False
+    if tx.isDoomed():
+        return False
+    try:
+        return not tx.data(mark_transaction_side_effect_free)
+    except KeyError:
+        return True
+
+
+def _lazy_host_site_ancestor_names(sites, site_components):
+    cache = sites._v_lazySiteAncestors # pylint:disable=protected-access
+    name = site_components.__name__
+    if cache is not None and name in cache:
+        return cache[name]
+    names = tuple(comps.__name__ for comps in ro.ro(site_components)[1:]
+                  if IComponents.providedBy(comps) and comps.__name__)
+    # Accessing the attribute may have loaded our state and discarded
+    # volatile attributes.
+    if sites._v_lazySiteAncestors is None: # pylint:disable=protected-access
+        sites._v_lazySiteAncestors = {}
+    sites._v_lazySiteAncestors[name] = names
+    return names
+
+
+def get_lazy_host_site(main_site, site_components):
+    """
+    Return the host site to use for the global *site_components* when
+    its persistent site does not exist, and host sites are created lazily
+    (see :attr:`.HostSitesFolder.lazySiteCreation`). Return None if they
+    are not.
+
+    If the current transaction can commit, the persistent site (and any
+    missing ancestors) is created and returned, just as
+    :func:`synchronize_host_policies` would have done. Otherwise, return a
+    transient site whose site manager has as its bases *site_components*
+    and the site manager of the nearest ancestor persistent site (or
+    of *main_site*).
+
+    This is used by :func:`nti.site.site.get_site_for_site_names`.
+
+    .. versionadded:: 3.1.0
+    """
+    try:
+        sites = main_site['++etc++hostsites']
+    except (KeyError, TypeError):
+        return None
+    if not sites.lazySiteCreation:
+        return None
+
+    name = site_components.__name__
+    main_site_manager = main_site.getSiteManager()
+    if _is_writable(sites):
+        # Don't store the order: computing it would load every site,
+        # and storing it would make concurrent first uses of
+        # different sites conflict.
+        _synchronize_host_site_ro(sites, ro.ro(site_components), main_site_manager)
+        return sites[name]
+
+    persistent_components = main_site_manager
+    for ancestor_name in _lazy_host_site_ancestor_names(sites, site_components):
+        if ancestor_name in sites:
+            persistent_components = sites.getHostSite(ancestor_name).getSiteManager()
+            break
+    site_manager = HostSiteManager(main_site.__parent__,
+                                   main_site.__name__,
+                                   site_components,
+                                   persistent_components)
+    site = TrivialSite(site_manager)
+    site.__parent__ = main_site
+    site.__name__ = name
+    return site
 
 
 def install_sites_folder(server_folder):
@@ -151,6 +302,230 @@ def install_sites_folder(server_folder):
     lsm.registerUtility(sites, provided=IEtcNamespace, name='hostsites')
     # synchronize_host_policies()
 
+#: A site to create with :func:`install_host_sites`. *parent* is the
+#: name of its parent host site, or None. *utilities* is a sequence of
+#: :class:`HostSiteUtilitySpec`.
+HostSiteSpec = namedtuple('HostSiteSpec', ('name', 'parent', 'utilities'))
+
+#: A local utility to create in a new site. The object created by
+#: calling *factory* is stored in the site manager under the traversal
+#: *name*, and registered to provide *provided* (without a registration
+#: name). *factory* and *provided* may be dotted names.
+HostSiteUtilitySpec = namedtuple('HostSiteUtilitySpec', ('name', 'factory', 'provided'))
+
+
+def read_host_site_manifest(source, format=None): # pylint:disable=redefined-builtin
+    """
+    Read a manifest of sites to provision and return a list of
+    :class:`HostSiteSpec`.
+
+    A JSON manifest is a list (or an object with a ``sites`` list) of
+    objects with the keys ``name``, ``parent`` (optional) and
+    ``utilities`` (optional); each utility is an object with the keys
+    ``name``, ``factory`` and ``provided``::
+
+        [{"name": "child.example.com", "parent": "example.com",
+          "utilities": [{"name": "catalog",
+                         "factory": "example.catalog.Catalog",
+                         "provided": "example.interfaces.ICatalog"}]}]
+
+    A CSV manifest has a header row and the columns ``name``,
+    ``parent``, ``utility_name``, ``utility_factory`` and
+    ``utility_provided``. A site with several utilities uses one row
+    for each of them.
+
+    :param source: A path, or an open file. Files are text, except
+        CSV files on Python 2, which must be opened in binary mode
+        (this function does that for paths).
+    :keyword str format: Either "json" or "csv". If not given, this is
+        taken from the extension of the path.
+
+    .. versionadded:: 3.1.0
+    """
+    if isinstance(source, string_types):
+        if format is None:
+            format = source.rsplit('.', 1)[-1]
+        if PY2 and format.lower() == 'csv':
+            # The Python 2 csv module only reads bytes.
+            f = open(source, 'rb')
+        else:
+            f = io.open(source, encoding='utf-8', newline='')
+        with f:
+            return read_host_site_manifest(f, format)
+
+    format = (format or 'json').lower()
+    if format == 'json':
+        data = json.load(source)
+        if isinstance(data, dict):
+            data = data['sites']
+        return [
+            HostSiteSpec(entry['name'],
+                         entry.get('parent') or None,
+                         tuple(HostSiteUtilitySpec(u['name'], u['factory'], u['provided'])
+                               for u in entry.get('utilities', ())))
+            for entry in data
+        ]
+    if format == 'csv':
+        specs = []
+        by_name = {}
+        for row in csv.DictReader(source):
+            if PY2:
+                row = dict((k.decode('utf-8'), v.decode('utf-8') if v else v)
+                           for k, v in row.items())
+            name = row['name']
+            if name not in by_name:
+                by_name[name] = HostSiteSpec(name, row.get('parent') or None, [])
+                specs.append(by_name[name])
+            if row.get('utility_name'):
+                by_name[name].utilities.append(
+                    HostSiteUtilitySpec(row['utility_name'],
+                                        row['utility_factory'],
+                                        row['utility_provided']))
+        return [spec._replace(utilities=tuple(spec.utilities)) for spec in specs]
+    raise ValueError("Unknown manifest format %r" % (format,))
+
+
+def _resolve_dotted_name(name):
+    if not isinstance(name, string_types):
+        return name
+    module_name, _, attr = name.rpartition('.')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def order_host_site_specs(specs):
+    """
+    Return a list of the :class:`HostSiteSpec` in *specs*, reordered
+    so that parents come before their children. The order is
+    otherwise kept.
+
+    .. versionadded:: 3.1.0
+    """
+    by_name = dict((spec.name, spec) for spec in specs)
+    seen = set()
+    ordered = []
+    for spec in specs:
+        chain = []
+        while spec is not None and spec.name not in seen:
+            seen.add(spec.name)
+            chain.append(spec)
+            spec = by_name.get(spec.parent)
+        ordered.extend(reversed(chain))
+    return ordered
+
+
+def _contain(container, name, obj, events):
+    # Like ``container[name] = obj``, but collecting the event instead of
+    # sending it. We call ``_setitemf`` directly, so we have to check
+    # the name the way ``zope.container.contained.setitem`` does.
+    if isinstance(name, bytes):
+        try:
+            name = name.decode('ascii')
+        except UnicodeError:
+            raise TypeError("name not unicode or ascii string")
+    elif not isinstance(name, text_type):
+        raise TypeError("name not unicode or ascii string")
+    if not name:
+        raise ValueError("empty names are not allowed")
+    if name in container:
+        raise KeyError(name)
+    obj, event = containedEvent(obj, container, name)
+    container._setitemf(name, obj) # pylint:disable=protected-access
+    if event is not None:
+        events.append(event)
+    return obj
+
+
+def install_host_sites(specs):
+    """
+    Create the persistent host sites described by the sequence of
+    :class:`HostSiteSpec` *specs*, along with their local utilities.
+    Sites that already exist are left alone.
+
+    Like :func:`synchronize_host_policies`, this must be called in a
+    transaction with a site that can find the host sites folder
+    current; you are responsible for committing.
+
+    Each new site's site manager has as its bases the global
+    :class:`~zope.interface.interfaces.IComponents` registered with
+    the site's name, if there is one, followed by the site manager of
+    its parent site (or of the main application folder if it has no
+    parent). Parents are created before their children, wherever they
+    are in *specs*.
+
+    Instead of notifying subscribers as each object is added, events
+    are sent in two batches: first the
+    :class:`~zope.lifecycleevent.interfaces.IObjectAddedEvent` for
+    each new folder, once all of them exist (but before they become
+    sites), followed by a single container modified event for the host
+    sites folder; then, once all the site managers and utilities
+    exist, the added and :class:`~zope.interface.interfaces.IRegistered`
+    events for the utilities, followed by a container modified event
+    for each site manager that got utilities. (``INewLocalSite`` is
+    still sent as each site manager is installed.)
+
+    :return: A list of the new sites.
+
+    .. versionadded:: 3.1.0
+    """
+    sites = get_host_sites_folder()
+    main_site_manager = sites.__parent__.getSiteManager()
+    global_sm = component.getGlobalSiteManager()
+
+    specs = [spec for spec in order_host_site_specs(specs)
+             if spec.name not in sites]
+    new_names = set(spec.name for spec in specs)
+    for spec in specs:
+        if spec.parent and spec.parent not in sites and spec.parent not in new_names:
+            raise ValueError("Unknown parent site %r for %r" % (spec.parent, spec.name))
+    if not specs:
+        return []
+
+    # First all the folders. These must be added before they become
+    # sites, or zope.site's handler for moved sites will reset the
+    # bases we give them.
+    events = []
+    created = []
+    for spec in specs:
+        logger.info("Installing site policy %s", spec.name)
+        created.append(_contain(sites, spec.name, HostPolicyFolder(), events))
+    for event in events:
+        notify(event)
+    notifyContainerModified(sites)
+
+    # Then their site managers and utilities.
+    events = []
+    modified = []
+    for site, spec in zip(created, specs):
+        parent_site_manager = (sites[spec.parent].getSiteManager()
+                               if spec.parent
+                               else main_site_manager)
+        site_policy = HostPolicySiteManager(site)
+        comps = global_sm.queryUtility(IComponents, name=spec.name)
+        site_policy.__bases__ = ((comps, parent_site_manager)
+                                 if comps is not None
+                                 else (parent_site_manager,))
+        # should fire INewLocalSite
+        site.setSiteManager(site_policy)
+        sites.indexSite(spec.name, spec.parent)
+
+        for utility_spec in spec.utilities:
+            provided = _resolve_dotted_name(utility_spec.provided)
+            utility = _resolve_dotted_name(utility_spec.factory)()
+            utility = _contain(site_policy, utility_spec.name, utility, events)
+            site_policy.registerUtility(utility, provided=provided, event=False)
+            events.append(Registered(
+                UtilityRegistration(site_policy, provided, '', utility, '', None)))
+        if spec.utilities:
+            modified.append(site_policy)
+
+    for event in events:
+        notify(event)
+    for container in modified:
+        notifyContainerModified(container)
+    _store_host_site_order(sites)
+    return created
+
+
 class _StrDefault(object):
     def __init__(self, val, description):
         assert isinstance(val, text_type)
@@ -328,51 +703,317 @@ def install_main_application_and_sites(conn,
 
     return root_folder, main_folder
 
+def _host_site_parent_names(site, sites):
+    """
+    Return the names of the sites in *sites* whose site managers
+    are direct bases of the site manager of *site*.
+    """
+    result = []
+    for base in site.getSiteManager().__bases__:
+        parent = getattr(base, '__parent__', None)
+        if IHostPolicySiteManager.providedBy(base) \
+           and getattr(parent, '__parent__', None) is sites:
+            result.append(parent.__name__)
+    return result
+
+def _host_site_parent_finder(sites):
+    """
+    Return a callable taking the name of a site in *sites* and returning
+    the names of its parent sites.
+
+    If *sites* has a site index, it is used, and no site is loaded;
+    otherwise, the site and its site manager are loaded to look at
+    the bases.
+    """
+    if sites.hasSiteIndex():
+        def find(name):
+            parent_name = sites.getParentSiteName(name)
+            return (parent_name,) if parent_name is not None else ()
+    else:
+        def find(name):
+            return _host_site_parent_names(sites[name], sites)
+    return find
+
+def _compute_host_site_order(sites):
+    """
+    Topologically sort the sites contained in *sites*, parents
+    before children, in time linear in the number of sites.
+
+    Sites with no parent come first, in name order; after that, the
+    order is breadth-first, with the children of each site in name order.
+
+    The parents are found from the site index, if there is one, so
+    that no site has to be loaded.
+    """
+    find_parent_names = _host_site_parent_finder(sites)
+    # BTree iteration is sorted by name.
+    names = list(sites.keys())
+    known = set(names)
+    children = {}
+    pending = {}
+    for name in names:
+        parent_names = [x for x in find_parent_names(name) if x in known]
+        pending[name] = len(parent_names)
+        for parent_name in parent_names:
+            children.setdefault(parent_name, []).append(name)
+
+    queue = deque(name for name in names if not pending[name])
+    ordered = []
+    while queue:
+        name = queue.popleft()
+        ordered.append(name)
+        for child in children.get(name, ()):
+            pending[child] -= 1
+            if not pending[child]:
+                queue.append(child)
+
+    if len(ordered) != len(names): # pragma: no cover
+        # A cycle; zope.interface.ro shouldn't have let this happen.
+        logger.error("Host sites have cyclic bases; ordering is arbitrary")
+        seen = set(ordered)
+        ordered.extend(name for name in names if name not in seen)
+    return ordered
+
 def get_all_host_sites():
     """
     The order in which sites are accessed is top-down breadth-first,
     that is, the shallowest to the deepest nested sites. This allows
     you to assume that your parent sites have already been updated.
 
+    .. versionchanged:: 3.1.0
+       The order is computed in linear time, and sites that share a
+       parent are returned in name order. The order is stored in the
+       host sites folder by the functions that create sites (except
+       lazily, on first use), and is out of date once a site is added,
+       removed or re-based; until it is stored again, each transaction
+       computes it once.
+
     :returns: A list of sites
     :rtype: list
     """
 
-    sites = component.getUtility(IEtcNamespace, name='hostsites')
-    sites = list(sites.values())
-
-    # The easyiest way to go top-down is to again use the resolution order;
-    # we just have to watch out for duplicates and non-persistent components
-    site_to_ro = {site: ro.ro(site.getSiteManager()) for site in sites}
-
-    # This should be a plain, directed acyclic tree (single root) that is now
-    # linearized.
-    # Transform from the site manager back into the site object itself
-    site_to_site_ro = {}
-    for site, managers in site_to_ro.items():
-        site_to_site_ro[site] = [getattr(x, '__parent__', None) for x in managers]
-
-    # Ok, now, go through the dictionary, walking from the top to the bottom,
-    # one at a time, thus producing the correct order
-    # (Because our datastructure looks like this:
-    #   site1: [site1, ds, base, GSM]
-    #   site2: [site2, site1, base, GSM]
-    #   site3: [site3, ds, base, GSM])
-    ordered = list()
-
-    while site_to_site_ro:
-        for site, managers in dict(site_to_site_ro).items():
-            if not managers:
-                site_to_site_ro.pop(site)
-                continue
+    sites = get_host_sites_folder()
+    return [sites[name] for name in _get_ordered_host_site_names(sites)]
+
+def _get_ordered_host_site_names(sites):
+    names = sites.getOrderedSiteNames()
+    if names is not None:
+        return names
+    # Don't turn readers into writers (and conflict with each other) by
+    # storing the order; just remember it for this transaction.
+    cache = sites._getTransactionCache() # pylint:disable=protected-access
+    if cache is not None and 'order' in cache:
+        return cache['order']
+    names = _compute_host_site_order(sites)
+    if cache is not None:
+        cache['order'] = names
+    return names
+
+def _store_host_site_order(sites):
+    """
+    Called by functions that change the sites, at the end: compute the
+    order of the sites, if needed, and store it in *sites*.
+    """
+    if sites.getOrderedSiteNames() is None:
+        sites.setOrderedSiteNames(_compute_host_site_order(sites))
 
-            base_site = managers.pop()
-            if base_site in sites and base_site not in ordered:
-                # Ie., it's a real one we haven't seen before
-                ordered.append(base_site)
-    return ordered
+def _deactivate_host_site(site):
+    """
+    Turn the site, its site manager and the site manager's registries
+    back into ghosts, and let the connection cache shrink. Objects with
+    unsaved changes are left alone by ``_p_deactivate``.
+    """
+    try:
+        site_manager = site.getSiteManager()
+    except ComponentLookupError: # pragma: no cover
+        site_manager = None
+    objects = (site,)
+    if site_manager is not None:
+        objects = (site_manager.adapters, site_manager.utilities, site_manager, site)
+    for obj in objects:
+        deactivate = getattr(obj, '_p_deactivate', None)
+        if deactivate is not None:
+            deactivate()
+    jar = getattr(site, '_p_jar', None)
+    if jar is not None:
+        jar.cacheGC()
+
+def get_host_site_shard(site_name, shard_count):
+    """
+    Return the index, from 0 to *shard_count* - 1, of the shard
+    that the site named *site_name* belongs to.
+
+    This is a stable hash of the name, so independent processes agree
+    on the partition without coordinating.
 
-def run_job_in_all_host_sites(func):
+    .. versionadded:: 3.1.0
+    """
+    if not isinstance(site_name, bytes):
+        site_name = site_name.encode('utf-8')
+    return (zlib.crc32(site_name) & 0xffffffff) % shard_count
+
+def _host_site_name_filter(shard_index, shard_count):
+    if shard_count is None:
+        if shard_index is not None:
+            raise ValueError("shard_index requires shard_count")
+        return lambda name: True
+    if shard_index is None or not 0 <= shard_index < shard_count:
+        raise ValueError("shard_index must be from 0 to %s" % (shard_count - 1,))
+    return lambda name: get_host_site_shard(name, shard_count) == shard_index
+
+def _host_site_prefetch_oids(site, requested):
+    # Return the OIDs of the persistent objects of *site* that should be
+    # prefetched next. We walk down from the folder, to its site manager,
+    # to the site manager's registries, but we can't know the OIDs an
+    # object refers to until it has been loaded. So the stages are
+    # pipelined: ghosts we asked for at an earlier step have probably
+    # arrived by now, and are activated (they'll be loaded when the site
+    # is visited anyway) so that we can ask for the next stage; we stop
+    # at the first stage with ghosts we haven't asked for yet.
+    result = []
+    def stage(objects):
+        loaded = True
+        for obj in objects:
+            oid = getattr(obj, '_p_oid', None)
+            if oid is None or obj._p_changed is not None:
+                continue
+            if oid in requested:
+                obj._p_activate()
+                continue
+            loaded = False
+            result.append(oid)
+        return loaded
+
+    if stage((site,)):
+        site_manager = site.getSiteManager()
+        if stage((site_manager,)):
+            stage((site_manager.adapters, site_manager.utilities))
+    return result
+
+def _prefetch_host_sites(sites, upcoming, requested):
+    oids = []
+    for site in upcoming:
+        oids.extend(_host_site_prefetch_oids(site, requested))
+    requested.update(oids)
+    jar = getattr(sites, '_p_jar', None)
+    if oids and jar is not None:
+        jar.prefetch(oids)
+
+def iter_all_host_sites(deactivate=True,
+                        shard_index=None,
+                        shard_count=None,
+                        predicate=None,
+                        prefetch=0):
+    """
+    Like :func:`get_all_host_sites`, but a generator that produces
+    the sites one at a time in the same top-down order, without
+    building a list.
+
+    :keyword bool deactivate: If true (the default), each site, its
+        site manager, and the site manager's registries are turned
+        back into ghosts once the caller asks for the next site (or
+        closes the generator), and the connection cache is
+        garbage collected. This keeps memory use bounded when
+        visiting many sites in one transaction. Objects that have
+        been modified are not deactivated.
+    :keyword int shard_count: If given, the sites are partitioned
+        into this many shards by :func:`get_host_site_shard`, and only
+        the sites in the shard numbered *shard_index* are produced.
+        Ancestors still come before their descendants within the
+        shard. The sites of other shards are not loaded, as long as the
+        order of the sites is known from the site index (see
+        :func:`get_host_subtree_sites`) or was stored by the functions
+        that create sites; otherwise, each site is loaded once per
+        transaction to find its parents.
+    :keyword callable predicate: If given, a callable taking a site;
+        only sites for which it returns true are produced.
+    :keyword int prefetch: If given, before each site is produced, ask
+        the storage to prefetch (see :meth:`ZODB.Connection.Connection.prefetch`)
+        the persistent objects needed by this many of the following
+        sites in the shard: their folders, their site managers, and the
+        site managers' registries. Each of those can only be found once
+        the one before it has been loaded, so this is done in a
+        pipeline: at each site, the objects that were asked for at an
+        earlier site are loaded (activated), and the objects they refer
+        to are asked for next. With a *prefetch* of at least 3, all
+        three stages of a site have been asked for before it is
+        produced. Storages that prefetch asynchronously, like ZEO, can
+        then overlap loading the next sites with the work done in the
+        current one. Storages that don't support prefetching ignore
+        this (apart from loading the upcoming objects a little early).
+
+    .. versionadded:: 3.1.0
+    """
+    in_shard = _host_site_name_filter(shard_index, shard_count)
+    sites = get_host_sites_folder()
+    names = [name for name in _get_ordered_host_site_names(sites) if in_shard(name)]
+    requested = set()
+    for i, name in enumerate(names):
+        site = sites[name]
+        if prefetch:
+            _prefetch_host_sites(sites,
+                                 [sites[x] for x in names[i + 1:i + 1 + prefetch]],
+                                 requested)
+        try:
+            if predicate is None or predicate(site):
+                yield site
+        finally:
+            if deactivate:
+                _deactivate_host_site(site)
+
+def get_all_host_site_levels(shard_index=None,
+                             shard_count=None,
+                             predicate=None):
+    """
+    Return the names of all the persistent host sites, grouped by
+    their depth in the site hierarchy.
+
+    The result is a list of lists. The first list contains the names of
+    the sites that have no parent host site, the second contains the
+    names of their children, and so on; each site appears in the list
+    after the deepest of its parents. Sites in the same list are
+    independent of each other, so jobs may safely run in them
+    concurrently once all the sites in the earlier lists are done.
+
+    The *shard_index*, *shard_count* and *predicate* arguments filter the
+    result as for :func:`iter_all_host_sites`; they do not change the
+    depths. The depths are found from the site index (see
+    :func:`get_host_subtree_sites`), so only the sites given to the
+    *predicate* are loaded (and then deactivated). Without the index,
+    every site has to be loaded.
+
+    .. versionadded:: 3.1.0
+    """
+    in_shard = _host_site_name_filter(shard_index, shard_count)
+    sites = get_host_sites_folder()
+    indexed = sites.hasSiteIndex()
+    find_parent_names = _host_site_parent_finder(sites)
+    depths = {}
+    levels = []
+    for name in _get_ordered_host_site_names(sites):
+        parent_names = [x for x in find_parent_names(name) if x in depths]
+        depth = max(depths[x] for x in parent_names) + 1 if parent_names else 0
+        depths[name] = depth
+        if depth == len(levels):
+            levels.append([])
+        loaded = not indexed
+        if in_shard(name):
+            wanted = True
+            if predicate is not None:
+                loaded = True
+                wanted = predicate(sites[name])
+            if wanted:
+                levels[depth].append(name)
+        if loaded:
+            _deactivate_host_site(sites[name])
+    return levels
+
+def run_job_in_all_host_sites(func,
+                              callback=None,
+                              shard_index=None,
+                              shard_count=None,
+                              predicate=None,
+                              prefetch=0):
     """
     While already operating inside of a transaction and the application
     environment, execute the callable given by ``func`` once for each
@@ -385,6 +1026,18 @@ def run_job_in_all_host_sites(func):
 
     You are responsible for transaction management.
 
+    .. versionchanged:: 3.1.0
+       Add the *callback*, *shard_index*, *shard_count*, *predicate*
+       and *prefetch* arguments.
+
+    :keyword callable callback: If given, the sites are visited with
+        :func:`iter_all_host_sites`, and this is called with each site
+        and the result of running the function in that site as soon as
+        it is available. Nothing is accumulated, and ``None`` is returned.
+    :keyword shard_index: See :func:`iter_all_host_sites`.
+    :keyword shard_count: See :func:`iter_all_host_sites`.
+    :keyword predicate: See :func:`iter_all_host_sites`.
+    :keyword prefetch: See :func:`iter_all_host_sites`.
     :raises: Whatever the callable raises.
     :returns: A list of pairs `(site, result)` containing each site
         and the result of running the function in that site.
@@ -393,23 +1046,73 @@ def run_job_in_all_host_sites(func):
 
     logger.debug("Asked to run job %s in ALL sites", func)
 
+    if callback is not None:
+        for site in iter_all_host_sites(shard_index=shard_index,
+                                        shard_count=shard_count,
+                                        predicate=predicate,
+                                        prefetch=prefetch):
+            callback(site, run_job_in_host_site(site, func))
+        return None
+
     results = list()
-    ordered = get_all_host_sites()
+    ordered = iter_all_host_sites(deactivate=False,
+                                  shard_index=shard_index,
+                                  shard_count=shard_count,
+                                  predicate=predicate,
+                                  prefetch=prefetch)
     for site in ordered:
         results.append(run_job_in_host_site(site, func))
     return results
 
+def get_host_sites_folder():
+    """
+    Return the :class:`~.IHostSitesFolder` registered as the "hostsites"
+    :class:`~zope.traversing.interfaces.IEtcNamespace` utility in the
+    current site.
+
+    The result is cached for the current site manager until the end of
+    the current transaction, so repeated calls don't repeat the
+    component lookup.
+
+    :raises zope.interface.interfaces.ComponentLookupError: If there
+        is no such utility.
+
+    .. versionadded:: 3.1.0
+    """
+    site_manager = component.getSiteManager()
+    try:
+        tx = transaction.manager.get()
+    except NoTransaction:
+        return site_manager.getUtility(IEtcNamespace, name='hostsites')
+
+    try:
+        cache = tx.data(get_host_sites_folder)
+    except KeyError:
+        cache = {}
+        tx.set_data(get_host_sites_folder, cache)
+
+    # Keep a reference to the site manager so its id can't be reused.
+    cached_manager, sites = cache.get(id(site_manager), (None, None))
+    if cached_manager is not site_manager:
+        sites = site_manager.getUtility(IEtcNamespace, name='hostsites')
+        cache[id(site_manager)] = (site_manager, sites)
+    return sites
+
 def get_host_site(site_name, safe=False):
     """
     Find the persistent site named *site_name* and return it.
 
+    .. versionchanged:: 3.1.0
+       Use the cached :func:`get_host_sites_folder` and
+       :meth:`.HostSitesFolder.getHostSite`.
+
     :keyword bool safe: If True, silently ignore any errors.
       **DO NOT** use this param. Deprecated and dangerous.
     """
-    site = str(site_name)
+    site = site_name if isinstance(site_name, str) else str(site_name)
     try:
-        sites = component.getUtility(IEtcNamespace, name='hostsites')
-        result = sites[site]
+        sites = get_host_sites_folder()
+        result = sites.getHostSite(site)
         return result
     except (ComponentLookupError, KeyError):
         if not safe:
@@ -429,3 +1132,58 @@ def run_job_in_host_site(site, func):
     with current_site(site):
         result = func()
         return result
+
+def _compute_host_site_children(sites):
+    """
+    Return a dict from site name to a list of the names of its direct
+    children, in name order, found from the bases of the site managers.
+    """
+    children = {}
+    for name in sites.keys():
+        for parent_name in _host_site_parent_names(sites[name], sites):
+            children.setdefault(parent_name, []).append(name)
+    return children
+
+def get_host_subtree_sites(site):
+    """
+    Return a list of the persistent *site* and all the persistent host
+    sites that descend from it, top-down (each site precedes its
+    children, and children of the same site are in name order).
+
+    This uses the child index maintained by
+    :func:`synchronize_host_policies` and does not need to examine
+    any unrelated site. If the index has not been built, the children
+    are found from the bases of every site's site manager instead.
+
+    :param site: Either the site object itself, or its unique name.
+
+    .. versionadded:: 3.1.0
+    """
+    site = get_host_site(site) if isinstance(site, string_types) else site
+    sites = get_host_sites_folder()
+    if sites.hasSiteIndex():
+        get_child_names = sites.getChildSiteNames
+    else:
+        children = _compute_host_site_children(sites)
+        get_child_names = lambda name: children.get(name, ())
+    result = [site]
+    queue = deque([site.__name__])
+    while queue:
+        for child_name in get_child_names(queue.popleft()):
+            result.append(sites[child_name])
+            queue.append(child_name)
+    return result
+
+def run_job_in_host_subtree(site, func):
+    """
+    Like :func:`run_job_in_all_host_sites`, but only execute *func*
+    in *site* and the sites descended from it, as given by
+    :func:`get_host_subtree_sites`.
+
+    :param site: Either the site object itself, or its unique name.
+    :returns: A list of the results of running the function in each site.
+
+    .. versionadded:: 3.1.0
+    """
+    logger.debug("Asked to run job %s in subtree of site %s", func, site)
+    return [run_job_in_host_site(x, func) for x in get_host_subtree_sites(site)]
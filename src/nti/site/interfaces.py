@@ -41,6 +41,16 @@ class SiteNotInstalledError(AssertionError):
     """
 
 
+class DeadlineExceededError(Exception):
+    """
+    Raised by :func:`nti.site.runner.check_deadline` when the deadline
+    of the current job has passed, and when a job is started after
+    its deadline.
+
+    .. versionadded:: 3.1.0
+    """
+
+
 class IMainApplicationFolder(IFolder):
     """
     The folder representing the application. The set of persistent
@@ -98,7 +108,8 @@ class ISiteTransactionRunner(interface.Interface):
     """
 
     def __call__(func, retries=0, sleep=None, site_names=(), side_effect_free=False,
-                 root_folder_name='nti.dataserver'):
+                 root_folder_name='nti.dataserver', read_only=False, snapshot=None,
+                 retry_policy=None, prefetch=None, deadline=None, join=False):
         """
         Runs the function given in `func` in a transaction and application local
         site manager (defaulting to the current site manager).
@@ -137,9 +148,207 @@ class ISiteTransactionRunner(interface.Interface):
             root of the ZODB that will serve as the starting point to look for the
             persistent named site.
 
+        :keyword bool read_only: If true (not the default), then
+            the function is run with a read-only view of the most recently
+            committed state of the database, using a normal pooled
+            connection. This implies *side_effect_free*: the transaction
+            is always aborted, never committed, and
+            attempting to change a persistent object raises an exception
+            immediately (:class:`ZODB.POSException.ReadOnlyHistoryError`
+            for ZODB). Because nothing is written, the function cannot
+            cause conflicts.
+
+            .. versionadded:: 3.1.0
+
+        :keyword snapshot: If given, run the function with a read-only
+            view of the database as it was *before* this transaction id
+            (or :class:`datetime.datetime`), instead of the latest state.
+            If this is True, use the state as of the latest committed
+            transaction when this is called; retries see the same state.
+            This implies *read_only*.
+
+            .. versionadded:: 3.1.0
+
+        :keyword retry_policy: An :class:`IRetryPolicy` that decides
+            how long to wait between attempts, instead of *sleep*. If
+            neither this nor *sleep* is given, a registered
+            :class:`IRetryPolicy` utility is used, if there is one.
+
+            .. versionadded:: 3.1.0
+
+        :keyword prefetch: A sequence of hints about the persistent
+            objects the function will use. Each is either an OID (bytes)
+            or a path (text) of ``/`` separated names to traverse from
+            the site. Before each attempt, the storage is asked to load
+            these objects in as few requests as possible (one for each
+            level of the paths).
+
+            .. versionadded:: 3.1.0
+
+        :keyword float deadline: If given, a time (as returned by
+            :func:`time.time`) after which no more attempts will be
+            started. If it has already passed when this is called, the
+            function is not run at all, and
+            :class:`.DeadlineExceededError` is raised; if it passes
+            while the function is being retried, the exception from the
+            last attempt is raised instead. The wait between attempts is
+            shortened so as not to pass the deadline. While it runs, the function can find out
+            how much time remains with
+            :func:`nti.site.runner.get_remaining_time`, or stop with
+            :func:`nti.site.runner.check_deadline`.
+
+            .. versionadded:: 3.1.0
+
+        :keyword bool join: If true (not the default), and this is
+            called while another job is running in this thread, with a
+            persistent site from the same database current, then instead
+            of opening another connection and beginning a new transaction,
+            run the function right away, as part of the current transaction,
+            with a savepoint. If the function raises an exception, its
+            changes are rolled back to the savepoint, and the exception
+            propagates. There are no retries (conflicts will happen when the
+            enclosing transaction commits), and *retries*, *sleep*,
+            *side_effect_free*, *retry_policy* and *prefetch* are ignored.
+            Read-only and snapshot jobs never join.
+
+            .. versionadded:: 3.1.0
+
         :return: The value returned by the first successful invocation of `func`.
         """
 
+class IRetryPolicy(interface.Interface):
+    """
+    Decides how long an :class:`ISiteTransactionRunner` waits before
+    trying a failed transaction again.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def getRetryDelay(attempt, exception, job_name=None):
+        """
+        Return the number of seconds to wait before the next attempt.
+
+        This is called each time an attempt fails with a retryable
+        exception.
+
+        :param int attempt: The number of attempts that have failed so far,
+            starting at 1.
+        :param exception: The exception that made the attempt fail,
+            typically a :class:`ZODB.POSException.ConflictError`.
+        :param str job_name: The name of the job, if it has one.
+        """
+
+
+class ISiteJobMetrics(interface.Interface):
+    """
+    Measurements of one call to an :class:`ISiteTransactionRunner`.
+
+    Times are in seconds, and are totals over all attempts unless
+    otherwise noted.
+
+    .. versionadded:: 3.1.0
+    """
+
+    job_name = interface.Attribute("The job name, or the name of the function.")
+    succeeded = interface.Attribute("Whether the job returned normally.")
+    exception_type = interface.Attribute(
+        "The name of the type of exception the job raised, or None.")
+    duration = interface.Attribute("The wall time of the whole call.")
+    attempts = interface.Attribute("How many times the function was run.")
+    retry_exceptions = interface.Attribute(
+        "A list of the names of the types of the exceptions that caused "
+        "retries, in order.")
+    site_resolution_time = interface.Attribute(
+        "Time spent finding the site to run in.")
+    handler_time = interface.Attribute("Time spent running the function.")
+    commit_time = interface.Attribute(
+        "Time from the end of the last attempt of the function until "
+        "its transaction finished committing (or aborting).")
+    loads = interface.Attribute(
+        "The number of objects loaded by the connection, if known.")
+    stores = interface.Attribute(
+        "The number of objects stored by the connection, if known.")
+
+
+class ISiteJobFinishedEvent(interface.Interface):
+    """
+    Notified when an :class:`ISiteTransactionRunner` finishes a job,
+    successfully or not.
+
+    .. versionadded:: 3.1.0
+    """
+
+    metrics = interface.Attribute("The :class:`ISiteJobMetrics`.")
+
+
+class ISiteJobProfiler(interface.Interface):
+    """
+    Decides which jobs run by an :class:`ISiteTransactionRunner` are
+    profiled with :mod:`cProfile`, and what to do with the profiles.
+
+    If there is no such utility, a profiler may be configured with
+    environment variables; see :class:`nti.site.runner.SiteJobProfiler`.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def shouldProfile(job_name):
+        """
+        Return whether to profile the job about to run.
+        """
+
+    def profileFinished(profile, job_name, duration):
+        """
+        Called with the :class:`cProfile.Profile` of a profiled job
+        after it finishes (successfully or not), and its wall time
+        in seconds.
+        """
+
+
+class ISiteWorkQueue(interface.Interface):
+    """
+    A persistent queue of jobs to run in one site, usually a local
+    utility of an :class:`IHostPolicyFolder`.
+
+    Jobs are picklable callables of no arguments.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def put(job):
+        """
+        Add *job* to the end of the queue.
+        """
+
+    def pull(count=1):
+        """
+        Remove and return a list of up to *count* jobs from the front of
+        the queue.
+        """
+
+    def peekKeys(count=1):
+        """
+        Return a list of the keys of up to *count* jobs at the front of
+        the queue, without removing them.
+        """
+
+    def pullKey(key):
+        """
+        Remove and return the job with the *key* returned by
+        :meth:`peekKeys`, or None if it is no longer queued.
+        """
+
+    def recordFailure(key):
+        """
+        Record that the job with *key* failed and was left in the
+        queue. Return the number of times this has been recorded for
+        it. The count is forgotten when the job is pulled.
+        """
+
+    def __len__():
+        "The number of queued jobs."
+
+
 class ISiteMapping(interface.Interface):
     """
     Maps a site name to an alternate site. Useful when we do not want full
@@ -8,23 +8,69 @@ Helpers for running jobs in specific sites.
 from __future__ import print_function, absolute_import, division
 __docformat__ = "restructuredtext en"
 
+import cProfile
+import fnmatch
+import functools
+import heapq
+import multiprocessing
+import operator
+import os
+import random
+import re
+import sys
+import threading
+import time
 import warnings
 
+from collections import OrderedDict
+from collections import deque
+from collections import namedtuple
+
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from six import string_types
+
+import transaction
+from transaction.interfaces import NoTransaction
+from transaction.interfaces import TransientError
 
 from zope import component
 from zope import interface
 
+from zope.component.hooks import getSite
 from zope.component.hooks import site as current_site
 
+from zope.event import notify
+
 from ZODB.interfaces import IDatabase
+from ZODB.DB import getTID
+from ZODB.POSException import ConflictError
+from ZODB.POSException import ReadOnlyHistoryError
+from ZODB.utils import oid_repr
 
 from nti.transactions.loop import TransactionLoop
 
+from nti.site.interfaces import DeadlineExceededError
 from nti.site.interfaces import SiteNotInstalledError
 
+from nti.site.interfaces import IRetryPolicy
+from nti.site.interfaces import IHostPolicyFolder
+from nti.site.interfaces import ISiteJobMetrics
+from nti.site.interfaces import ISiteJobProfiler
+from nti.site.interfaces import ISiteJobFinishedEvent
 from nti.site.interfaces import ITransactionSiteNames
 from nti.site.interfaces import ISiteTransactionRunner
 
+from nti.site.hostpolicy import install_host_sites
+from nti.site.hostpolicy import iter_all_host_sites
+from nti.site.hostpolicy import get_host_site_shard
+from nti.site.hostpolicy import order_host_site_specs
+from nti.site.hostpolicy import read_host_site_manifest
+from nti.site.hostpolicy import get_all_host_site_levels
+from nti.site.hostpolicy import mark_transaction_side_effect_free
+
 from nti.site.site import get_site_for_site_names
 
 logger = __import__('logging').getLogger(__name__)
@@ -37,16 +83,525 @@ def _tx_string(s):
     return s.decode('utf-8', 'replace') if isinstance(s, bytes) else s
 
 
+class SiteJobStatistics(object):
+    """
+    The totals of the :class:`.ISiteJobMetrics` of one job name, as
+    kept by :class:`SiteJobMetricsCollector`.
+
+    .. versionadded:: 3.1.0
+    """
+
+    count = 0
+    failures = 0
+    attempts = 0
+    duration = 0.0
+    max_duration = 0.0
+    site_resolution_time = 0.0
+    handler_time = 0.0
+    commit_time = 0.0
+    loads = 0
+    stores = 0
+
+    def __init__(self, job_name):
+        self.job_name = job_name
+        #: Map from exception type name to the number of retries it caused.
+        self.retry_exceptions = {}
+
+    @property
+    def mean_duration(self):
+        return self.duration / self.count if self.count else 0.0
+
+    def record(self, metrics):
+        self.count += 1
+        if not metrics.succeeded:
+            self.failures += 1
+        self.attempts += metrics.attempts
+        self.duration += metrics.duration
+        self.max_duration = max(self.max_duration, metrics.duration)
+        self.site_resolution_time += metrics.site_resolution_time
+        self.handler_time += metrics.handler_time
+        self.commit_time += metrics.commit_time
+        self.loads += metrics.loads or 0
+        self.stores += metrics.stores or 0
+        for name in metrics.retry_exceptions:
+            self.retry_exceptions[name] = self.retry_exceptions.get(name, 0) + 1
+
+    def __repr__(self):
+        return '<%s %s count=%s duration=%.3f>' % (
+            type(self).__name__, self.job_name, self.count, self.duration)
+
+
+class SiteJobMetricsCollector(object):
+    """
+    Aggregates the metrics of finished jobs in memory, by job name.
+
+    An instance is a subscriber for :class:`.ISiteJobFinishedEvent`::
+
+        collector = SiteJobMetricsCollector()
+        component.provideHandler(collector, (ISiteJobFinishedEvent,))
+        ...
+        for stats in collector.getMostExpensive(10):
+            print(stats.job_name, stats.count, stats.duration)
+
+    It is thread safe.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statistics = {}
+
+    def __call__(self, event):
+        self.record(event.metrics)
+
+    def record(self, metrics):
+        with self._lock:
+            stats = self._statistics.get(metrics.job_name)
+            if stats is None:
+                stats = self._statistics[metrics.job_name] = SiteJobStatistics(metrics.job_name)
+            stats.record(metrics)
+
+    def getStatistics(self, job_name):
+        """
+        Return the :class:`SiteJobStatistics` for *job_name*, or None.
+        """
+        return self._statistics.get(job_name)
+
+    def getAllStatistics(self):
+        """
+        Return a list of all the :class:`SiteJobStatistics`.
+        """
+        with self._lock:
+            return list(self._statistics.values())
+
+    def getMostExpensive(self, count=10, key='duration'):
+        """
+        Return the *count* :class:`SiteJobStatistics` with the largest
+        value of the attribute *key* (for example, ``handler_time``,
+        ``attempts`` or ``loads``), largest first.
+        """
+        return heapq.nlargest(count, self.getAllStatistics(),
+                              key=operator.attrgetter(key))
+
+    def clear(self):
+        with self._lock:
+            self._statistics.clear()
+
+
+#: How often one kind of conflict has happened, as reported by
+#: :meth:`ConflictHotSpots.getTopOffenders`. *oid* and *class_name*
+#: are None if the :class:`~ZODB.POSException.ConflictError` didn't
+#: say. *last_seen* is a :func:`time.time` value.
+ConflictHotSpot = namedtuple('ConflictHotSpot',
+                             ('job_name', 'oid', 'class_name', 'site_name',
+                              'count', 'last_seen'))
+
+
+class ConflictHotSpots(object):
+    """
+    Counts the :class:`~ZODB.POSException.ConflictError` exceptions
+    raised by attempts of site jobs, by job name, OID, class of the
+    object and the name of the site the job ran in. This shows which
+    objects would benefit from conflict resolution or being split up.
+
+    The site job runners record every conflict of every attempt in
+    :data:`conflict_hot_spots`, whether or not the job is retried.
+
+    At most *max_entries* combinations are remembered; when there are
+    more, those seen least recently are forgotten. It is thread safe.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> [count, last seen]
+        self._lock = threading.Lock()
+
+    def record(self, job_name, exception, site_name=None, now=None):
+        key = (job_name,
+               getattr(exception, 'oid', None),
+               getattr(exception, 'class_name', None),
+               site_name)
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.pop(key, None) or [0, None]
+            entry[0] += 1
+            entry[1] = now
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def getTopOffenders(self, count=10):
+        """
+        Return a list of up to *count* :class:`ConflictHotSpot`, most
+        conflicts first.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        top = heapq.nlargest(count, entries, key=lambda item: item[1][0])
+        return [ConflictHotSpot(*(key + tuple(entry))) for key, entry in top]
+
+    def formatTopOffenders(self, count=10):
+        """
+        Return a table of :meth:`getTopOffenders` as text, for logging.
+        """
+        lines = ['%6s %-18s %-30s %-30s %s' % ('Count', 'OID', 'Class', 'Site', 'Job')]
+        for spot in self.getTopOffenders(count):
+            lines.append('%6d %-18s %-30s %-30s %s' % (
+                spot.count,
+                oid_repr(spot.oid) if spot.oid is not None else '-',
+                spot.class_name or '-',
+                spot.site_name or '-',
+                spot.job_name))
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+#: The :class:`ConflictHotSpots` the site job runners record into.
+conflict_hot_spots = ConflictHotSpots()
+
+
+_deadlines = threading.local()
+
+def _get_deadline_stack():
+    stack = getattr(_deadlines, 'stack', None)
+    if stack is None:
+        stack = _deadlines.stack = []
+    return stack
+
+
+def _remaining_time(deadline):
+    return deadline - time.time() if deadline is not None else None
+
+
+def get_remaining_time():
+    """
+    Return the number of seconds until the deadline of the job running
+    in this thread (see :class:`.ISiteTransactionRunner`), which may
+    be negative, or None if it has no deadline.
+
+    When jobs are nested, the earliest deadline applies.
+
+    .. versionadded:: 3.1.0
+    """
+    deadlines = [d for d in _get_deadline_stack() if d is not None]
+    return _remaining_time(min(deadlines)) if deadlines else None
+
+
+def check_deadline():
+    """
+    Raise :class:`.DeadlineExceededError` if the deadline of the job
+    running in this thread has passed. Long-running jobs should call
+    this periodically.
+
+    .. versionadded:: 3.1.0
+    """
+    _check_remaining_time(get_remaining_time())
+
+
+def _check_remaining_time(remaining):
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError("Deadline passed %.3fs ago" % (-remaining,))
+
+
+def iter_in_bounded_memory(iterable,
+                           savepoint_interval=1000,
+                           gc_interval=100,
+                           deactivate=True):
+    """
+    Iterate *iterable* inside a job, keeping the memory used by the
+    connection cache and the transaction bounded, no matter how many
+    persistent objects are visited or changed.
+
+    - When the caller asks for the next item, the previous one is
+      turned back into a ghost if it is persistent (and *deactivate* is
+      true). Objects with unsaved changes can't be; they are turned
+      into ghosts after the next savepoint.
+    - Every *savepoint_interval* items, an optimistic savepoint is
+      taken. This writes the changed objects to the savepoint's
+      temporary storage so they no longer have to stay in memory.
+    - Every *gc_interval* items, the connection of the first
+      persistent item has its cache garbage collected
+      (:meth:`ZODB.Connection.Connection.cacheGC`), which removes
+      unused objects beyond the cache's target size.
+
+    Pass 0 or None to turn off savepoints or garbage collection.
+    Everything is still committed (or aborted) as one transaction.
+
+    .. versionadded:: 3.1.0
+    """
+    unsaved = []
+    jar = None
+    for count, obj in enumerate(iterable, 1):
+        yield obj
+        obj_jar = getattr(obj, '_p_jar', None)
+        if jar is None:
+            jar = obj_jar
+        if deactivate and obj_jar is not None:
+            if obj._p_changed:
+                unsaved.append(obj)
+            else:
+                obj._p_deactivate()
+        if savepoint_interval and count % savepoint_interval == 0:
+            transaction.savepoint(optimistic=True)
+            for changed in unsaved:
+                changed._p_deactivate()
+            del unsaved[:]
+        if gc_interval and jar is not None and count % gc_interval == 0:
+            jar.cacheGC()
+
+
+@interface.implementer(ISiteJobProfiler)
+class SiteJobProfiler(object):
+    """
+    Profiles jobs whose name matches *pattern* (a :mod:`fnmatch`
+    pattern), and a random *sample_rate* fraction (from 0 to 1) of all
+    jobs. If neither is given, all jobs are profiled.
+
+    Only the profiles of jobs that take at least *threshold* seconds
+    are kept. Each is written to a ``.pstats`` file (see
+    :mod:`pstats`) in *directory*, which is created if needed. At
+    most *max_files* files are written by each profiler.
+
+    Register one of these as an :class:`.ISiteJobProfiler` utility, or
+    set the environment variable ``NTI_SITE_JOB_PROFILE_DIR`` to the
+    directory; ``NTI_SITE_JOB_PROFILE_PATTERN``,
+    ``NTI_SITE_JOB_PROFILE_RATE``, ``NTI_SITE_JOB_PROFILE_THRESHOLD``
+    and ``NTI_SITE_JOB_PROFILE_MAX_FILES`` give the other arguments.
+
+    Jobs are not profiled if another profiler is already running in
+    their thread.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def __init__(self, directory, pattern=None, sample_rate=None,
+                 threshold=1.0, max_files=100):
+        self.directory = directory
+        self.pattern = pattern
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.max_files = max_files
+        self.files_written = 0
+        self.random = random.Random()
+        self._lock = threading.Lock()
+
+    def shouldProfile(self, job_name):
+        if self.files_written >= self.max_files:
+            return False
+        if self.pattern is None and self.sample_rate is None:
+            return True
+        if self.pattern is not None and fnmatch.fnmatchcase(job_name, self.pattern):
+            return True
+        return bool(self.sample_rate) and self.random.random() < self.sample_rate
+
+    def _get_path(self, job_name):
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', job_name)[:100]
+        return os.path.join(self.directory,
+                            '%s-%d-%d-%d.pstats' % (name,
+                                                    int(time.time() * 1000),
+                                                    os.getpid(),
+                                                    threading.current_thread().ident))
+
+    def profileFinished(self, profile, job_name, duration):
+        if duration < self.threshold:
+            return
+        with self._lock:
+            if self.files_written >= self.max_files:
+                return
+            self.files_written += 1
+        path = self._get_path(job_name)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profile.dump_stats(path)
+        except (IOError, OSError):
+            logger.exception("Failed to write profile of %s", job_name)
+        else:
+            logger.info("Wrote profile of %s (%.3fs) to %s", job_name, duration, path)
+
+
+_PROFILE_ENVIRON = (
+    'NTI_SITE_JOB_PROFILE_DIR',
+    'NTI_SITE_JOB_PROFILE_PATTERN',
+    'NTI_SITE_JOB_PROFILE_RATE',
+    'NTI_SITE_JOB_PROFILE_THRESHOLD',
+    'NTI_SITE_JOB_PROFILE_MAX_FILES',
+)
+
+# The values of the environment variables, and the profiler made from them.
+_environ_profiler = (None, None)
+
+def _make_environ_profiler(directory, pattern, rate, threshold, max_files):
+    if not directory:
+        return None
+    try:
+        return SiteJobProfiler(directory,
+                               pattern=pattern or None,
+                               sample_rate=float(rate) if rate else None,
+                               threshold=float(threshold) if threshold else 1.0,
+                               max_files=int(max_files) if max_files else 100)
+    except ValueError:
+        logger.exception("Invalid job profiling settings in the environment")
+        return None
+
+def _get_site_job_profiler():
+    global _environ_profiler # pylint:disable=global-statement
+    profiler = component.queryUtility(ISiteJobProfiler)
+    if profiler is None:
+        environ = tuple(os.environ.get(name) for name in _PROFILE_ENVIRON)
+        if environ != _environ_profiler[0]:
+            _environ_profiler = (environ, _make_environ_profiler(*environ))
+        profiler = _environ_profiler[1]
+    return profiler
+
+def _start_profile():
+    if sys.getprofile() is not None:
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError: # pragma: no cover
+        # Another profiler is active (Python 3.12+)
+        return None
+    return profile
+
+
+class _NoRandomBackoff(object):
+    @staticmethod
+    def randint(_a, _b):
+        return 1
+
+_NO_RANDOM_BACKOFF = _NoRandomBackoff()
+
+
+@interface.implementer(ISiteJobMetrics)
+class SiteJobMetrics(object):
+    """
+    Default implementation of :class:`.ISiteJobMetrics`.
+
+    .. versionadded:: 3.1.0
+    """
+
+    succeeded = False
+    exception_type = None
+    duration = 0.0
+    attempts = 0
+    site_resolution_time = 0.0
+    handler_time = 0.0
+    commit_time = 0.0
+    loads = None
+    stores = None
+
+    def __init__(self, job_name):
+        self.job_name = job_name
+        self.retry_exceptions = []
+
+    def __repr__(self):
+        return '<%s %s attempts=%s duration=%.3f>' % (
+            type(self).__name__, self.job_name, self.attempts, self.duration)
+
+
+@interface.implementer(ISiteJobFinishedEvent)
+class SiteJobFinishedEvent(object):
+    """
+    Default implementation of :class:`.ISiteJobFinishedEvent`.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+
+def _prefetch_hints(connection, site, hints):
+    """
+    Ask the storage to load, in as few requests as possible, the
+    objects named by *hints*: OIDs (bytes), or paths (text) of
+    ``/``-separated names to traverse from *site* with ``__getitem__``.
+
+    A path can only be followed one step at a time, so all the paths
+    are followed in parallel, with one prefetch request for each level.
+    The OIDs are requested with the first level.
+    """
+    prefetch = getattr(connection, 'prefetch', None)
+    if prefetch is None: # pragma: no cover
+        return
+    oids = []
+    current = []
+    for hint in hints:
+        if isinstance(hint, bytes):
+            oids.append(hint)
+        else:
+            current.append((site, [name for name in hint.split('/') if name]))
+
+    while oids or current:
+        wanted = oids + [obj for obj, _ in current
+                         if getattr(obj, '_p_changed', False) is None]
+        oids = []
+        if wanted:
+            prefetch(wanted)
+        following = []
+        for obj, path in current:
+            if not path:
+                continue
+            try:
+                following.append((obj[path[0]], path[1:]))
+            except (KeyError, TypeError, AttributeError):
+                logger.debug("Unable to prefetch %s in %r", path, obj)
+        current = following
+
+
 class _RunJobInSite(TransactionLoop):
 
     _connection = None
+    _root_folder = None
+    # Did we open the connection, or was it given to us?
+    _own_connection = True
+
+    _metrics = None
+    # Connection transfer counts when we started, and when the handler
+    # last finished.
+    _start_counts = None
+    _handler_finished = None
+    # The name of the site the last attempt ran in.
+    _site_name = None
 
     def __init__(self, *args, **kwargs):
         self.site_names = kwargs.pop('site_names')
         self.job_name = kwargs.pop('job_name')
         self.side_effect_free = kwargs.pop('side_effect_free')
         self.root_folder_name = kwargs.pop('root_folder_name')
+        self.host_site_name = kwargs.pop('host_site_name', None)
+        self.checkpoint = kwargs.pop('checkpoint', None)
+        self.read_only = kwargs.pop('read_only', False)
+        self.before = kwargs.pop('before', None)
+        if self.before is not None:
+            self.read_only = True
+        if self.read_only:
+            self.side_effect_free = True
+        self.session = session = kwargs.pop('session', None)
+        retry_policy = kwargs.pop('retry_policy', None)
+        self.prefetch = kwargs.pop('prefetch', None)
+        self.deadline = kwargs.pop('deadline', None)
         super(_RunJobInSite, self).__init__(*args, **kwargs)
+        self._base_sleep = self.sleep
+        if retry_policy is None and self.sleep is None:
+            retry_policy = component.queryUtility(IRetryPolicy)
+        self.retry_policy = retry_policy
+        self._failed_attempts = 0
+        if session is not None:
+            self._connection = session.connection
+            self._root_folder = session.root_folder
+            self._own_connection = False
 
     def describe_transaction(self, *args, **kwargs):
         if self.job_name:
@@ -67,29 +622,177 @@ class _RunJobInSite(TransactionLoop):
 
         return note
 
+    def _metrics_job_name(self):
+        if self.job_name:
+            return self.job_name
+        return getattr(self.handler, '__name__', None) or type(self.handler).__name__
+
+    def __call__(self, *args, **kwargs):
+        self._metrics = metrics = SiteJobMetrics(self._metrics_job_name())
+        self._handler_finished = None
+        start = time.time()
+        deadlines = _get_deadline_stack()
+        deadlines.append(self.deadline)
+        profiler = _get_site_job_profiler()
+        profile = None
+        if profiler is not None and profiler.shouldProfile(metrics.job_name):
+            profile = _start_profile()
+        try:
+            # Don't start the first attempt either once it's too late.
+            _check_remaining_time(_remaining_time(self.deadline))
+            result = super(_RunJobInSite, self).__call__(*args, **kwargs)
+            metrics.succeeded = True
+            return result
+        except BaseException as e:
+            metrics.exception_type = type(e).__name__
+            raise
+        finally:
+            deadlines.pop()
+            metrics.duration = time.time() - start
+            if profile is not None:
+                profile.disable()
+                try:
+                    profiler.profileFinished(profile, metrics.job_name, metrics.duration)
+                except Exception: # pylint:disable=broad-except
+                    logger.exception("Failed to handle the profile of %s", metrics.job_name)
+            notify(SiteJobFinishedEvent(metrics))
+
+    def _retryable(self, tx, exc_info):
+        # Every conflict counts, especially those that fail the job.
+        if isinstance(exc_info[1], ConflictError):
+            conflict_hot_spots.record(self._metrics.job_name, exc_info[1],
+                                      self._site_name)
+        retryable = super(_RunJobInSite, self)._retryable(tx, exc_info)
+        # The loop asks even when no attempts remain; don't record or
+        # plan a retry that won't happen.
+        if not retryable or self._failed_attempts + 1 >= self.attempts:
+            return retryable
+        remaining = _remaining_time(self.deadline)
+        if remaining is not None and remaining <= 0:
+            logger.info("Deadline passed; not retrying %s after %r",
+                        self._metrics.job_name, exc_info[1])
+            return False
+        self._metrics.retry_exceptions.append(type(exc_info[1]).__name__)
+        self._failed_attempts += 1
+
+        delay = None
+        if self.retry_policy is not None:
+            delay = self.retry_policy.getRetryDelay(self._failed_attempts,
+                                                    exc_info[1],
+                                                    self.job_name)
+        elif remaining is not None and self._base_sleep:
+            # The superclass's binary exponential backoff.
+            delay = self._base_sleep * random.randint(0, 2 ** self._failed_attempts - 1)
+        if delay is not None:
+            if remaining is not None:
+                delay = min(delay, remaining)
+            # The superclass sleeps for ``sleep * random.randint(...)``
+            # and notifies subscribers first; make that our delay.
+            self.sleep = delay
+            self.random = _NO_RANDOM_BACKOFF
+        return retryable
+
     def run_handler(self, *args, **kwargs): # pylint:disable=arguments-differ
-        sitemanc = self._connection.root()[self.root_folder_name]
-        # Put into a policy if need be
-        sitemanc = get_site_for_site_names(self.site_names, sitemanc)
+        metrics = self._metrics
+        metrics.attempts += 1
+        started = time.time()
+        if self._root_folder is None:
+            self._root_folder = self._connection.root()[self.root_folder_name]
+            if self.session is not None:
+                self.session.root_folder = self._root_folder
+        if self.side_effect_free:
+            # Don't let finding the site create it, only to be aborted.
+            mark_transaction_side_effect_free(
+                self._connection.transaction_manager.get())
+        sitemanc = self._root_folder
+        host_sites = None
+        if self.host_site_name:
+            # A specific persistent host site
+            host_sites = sitemanc['++etc++hostsites']
+            sitemanc = host_sites[self.host_site_name]
+        else:
+            # Put into a policy if need be
+            sitemanc = get_site_for_site_names(self.site_names, sitemanc)
+        self._site_name = getattr(sitemanc, '__name__', None)
 
         with current_site(sitemanc):
             if component.getSiteManager() != sitemanc.getSiteManager():
                 raise SiteNotInstalledError("Hooks not installed?")
-            return self.handler(*args, **kwargs)
+            if self.prefetch:
+                _prefetch_hints(self._connection, sitemanc, self.prefetch)
+            resolved = time.time()
+            metrics.site_resolution_time += resolved - started
+            try:
+                result = self.handler(*args, **kwargs)
+            finally:
+                self._handler_finished = time.time()
+                metrics.handler_time += self._handler_finished - resolved
+            if self.checkpoint and host_sites is not None:
+                # Commits, or not, along with the handler's work.
+                sitemanc.addJobCheckpoint(self.checkpoint)
+            return result
 
     def setUp(self):
-        # After the transaction manager has been put into explicit
-        # mode, open the connection. This lets it perform certain
-        # optimizations.
-        db = component.getUtility(IDatabase)
-        self._connection = db.open()
+        if self._own_connection:
+            # After the transaction manager has been put into explicit
+            # mode, open the connection. This lets it perform certain
+            # optimizations.
+            db = component.getUtility(IDatabase)
+            self._connection = self._open_connection(db)
+        self._start_counts = self._get_transfer_counts()
+
+    def _get_transfer_counts(self):
+        # Don't clear them; the database's activity monitor uses them.
+        get_counts = getattr(self._connection, 'getTransferCounts', None)
+        return get_counts() if get_counts is not None else None
+
+    def _record_connection_metrics(self):
+        metrics = self._metrics
+        if metrics is None:
+            return
+        if self._handler_finished is not None:
+            metrics.commit_time = time.time() - self._handler_finished
+        end_counts = self._get_transfer_counts()
+        if self._start_counts is not None and end_counts is not None:
+            metrics.loads = end_counts[0] - self._start_counts[0]
+            metrics.stores = end_counts[1] - self._start_counts[1]
+
+    def _open_connection(self, db):
+        if not self.read_only:
+            return db.open()
+        if self.before is not None:
+            conn = db.open(before=self.before)
+        else:
+            # A normal pooled connection, with its warm cache. Being
+            # side-effect free, the transaction is aborted, never
+            # committed, so it can't conflict.
+            conn = db.open()
+        # A historical connection would only complain when the
+        # transaction commits, and a normal one would only be aborted,
+        # so reject the change as soon as it's made. Not registering
+        # the object also means the connection never joins the
+        # transaction.
+        conn.register = self._reject_change
+        return conn
+
+    def _reject_change(self, obj):
+        # Discard whatever in-memory change was already made,
+        # since aborting won't.
+        obj._p_invalidate()
+        raise ReadOnlyHistoryError(
+            "Cannot change %s.%s (oid %r) in a read-only job" % (
+                type(obj).__module__, type(obj).__name__, obj._p_oid))
 
     def tearDown(self):
-        if self._connection is not None:
+        self._record_connection_metrics()
+        if self._connection is not None and self._own_connection:
             try:
+                if self.read_only:
+                    del self._connection.register
                 self._connection.close()
             finally:
                 self._connection = None
+                self._root_folder = None
 
 
 _marker = object()
@@ -104,6 +807,67 @@ def get_possible_site_names(*args, **kwargs):
     result = utility(*args, **kwargs) if utility is not None else None
     return result
 
+def _get_joinable_connection(read_only):
+    # If there's a transaction in progress in this thread, started by a
+    # transaction loop (which puts the manager in explicit mode), and
+    # the current site comes from a writable connection to our database,
+    # return that connection.
+    txm = transaction.manager.manager
+    if read_only or not txm.explicit:
+        return None
+    try:
+        tx = txm.get()
+    except NoTransaction:
+        return None
+    if tx.isDoomed():
+        return None
+    site = getSite()
+    jar = getattr(site, '_p_jar', None)
+    db = component.queryUtility(IDatabase)
+    if (jar is None
+            or db is None
+            or jar.db() is not db
+            or getattr(jar, 'before', None) is not None
+            or jar.transaction_manager is not txm):
+        return None
+    return jar
+
+
+def _run_job_in_current_transaction(connection, func, site_names, job_name,
+                                    root_folder_name, deadline):
+    metrics = SiteJobMetrics(job_name
+                             or getattr(func, '__name__', None)
+                             or type(func).__name__)
+    deadlines = _get_deadline_stack()
+    deadlines.append(deadline)
+    start = time.time()
+    try:
+        _check_remaining_time(_remaining_time(deadline))
+        metrics.attempts = 1
+        sitemanc = connection.root()[root_folder_name]
+        sitemanc = get_site_for_site_names(site_names, sitemanc)
+        with current_site(sitemanc):
+            resolved = time.time()
+            metrics.site_resolution_time = resolved - start
+            savepoint = transaction.savepoint()
+            try:
+                result = func()
+            except BaseException:
+                savepoint.rollback()
+                raise
+            finally:
+                metrics.handler_time = time.time() - resolved
+        metrics.succeeded = True
+        return result
+    except BaseException as e:
+        metrics.exception_type = type(e).__name__
+        raise
+    finally:
+        deadlines.pop()
+        metrics.duration = time.time() - start
+        notify(SiteJobFinishedEvent(metrics))
+
+
 @interface.provider(ISiteTransactionRunner)
 def run_job_in_site(func,
                     retries=0,
@@ -111,7 +875,13 @@ def run_job_in_site(func,
                     site_names=_marker,
                     job_name=None,
                     side_effect_free=False,
-                    root_folder_name=u'nti.dataserver'):
+                    root_folder_name=u'nti.dataserver',
+                    read_only=False,
+                    snapshot=None,
+                    retry_policy=None,
+                    prefetch=None,
+                    deadline=None,
+                    join=False):
     """
     Runs the function given in `func` in a transaction and dataserver local
     site manager. See :class:`.ISiteTransactionRunner`
@@ -130,6 +900,13 @@ def run_job_in_site(func,
     else:
         site_names = get_possible_site_names()
 
+    if join:
+        connection = _get_joinable_connection(read_only or snapshot)
+        if connection is not None:
+            return _run_job_in_current_transaction(connection, func, site_names,
+                                                   job_name, root_folder_name,
+                                                   deadline)
+
     return _RunJobInSite(
         func,
         retries=retries,
@@ -137,7 +914,702 @@ def run_job_in_site(func,
         site_names=site_names,
         job_name=job_name,
         side_effect_free=side_effect_free,
-        root_folder_name=root_folder_name
+        root_folder_name=root_folder_name,
+        read_only=read_only,
+        before=_snapshot_before(snapshot),
+        retry_policy=retry_policy,
+        prefetch=prefetch,
+        deadline=deadline,
     )()
 
 run_job_in_site.__doc__ = ISiteTransactionRunner['__call__'].getDoc()
+
+
+def _snapshot_before(snapshot):
+    # Turn the *snapshot* argument into the *before* argument
+    # of IDatabase.open().
+    if snapshot is None or snapshot is False:
+        return None
+    if snapshot is True:
+        db = component.getUtility(IDatabase)
+        return getTID(db.lastTransaction(), None)
+    return getTID(None, snapshot)
+
+
+@interface.implementer(IRetryPolicy)
+class ExponentialBackoffRetryPolicy(object):
+    """
+    Wait a random time between zero and an exponentially growing
+    ceiling ("full jitter"), so that jobs that conflicted with each
+    other don't all retry at the same moment and conflict again.
+
+    The ceiling for the *n* th retry is ``base * factor ** (n - 1)``,
+    but never more than *cap*.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def __init__(self, base=0.05, cap=5.0, factor=2.0):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.random = random.SystemRandom()
+
+    def _ceiling(self, exponent):
+        # Don't overflow with absurd numbers of attempts.
+        exponent = min(exponent, 64)
+        return min(self.cap, self.base * self.factor ** exponent)
+
+    def getRetryDelay(self, attempt, exception, job_name=None):
+        return self.random.uniform(0, self._ceiling(attempt - 1))
+
+
+class ConflictAwareRetryPolicy(ExponentialBackoffRetryPolicy):
+    """
+    Like :class:`ExponentialBackoffRetryPolicy`, but also remembers the
+    objects (by OID) that recently caused conflicts, across all jobs
+    using this policy. A retry caused by an object that has conflicted
+    again within *window* seconds waits as if it had already been
+    retried that many more times.
+
+    One instance of this should be shared by the jobs that contend;
+    registering it as the :class:`~.IRetryPolicy` utility does that.
+    It is thread safe, and remembers at most *max_oids* objects.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def __init__(self, base=0.05, cap=5.0, factor=2.0, window=10.0, max_oids=1000):
+        super(ConflictAwareRetryPolicy, self).__init__(base, cap, factor)
+        self.window = window
+        self.max_oids = max_oids
+        self._conflicts = OrderedDict() # oid -> (count, last time)
+        self._lock = threading.Lock()
+
+    def _record_conflict(self, oid, now):
+        # Return how many other conflicts the oid had within the window.
+        with self._lock:
+            count, last = self._conflicts.pop(oid, (0, None))
+            if last is None or now - last > self.window:
+                count = 0
+            self._conflicts[oid] = (count + 1, now)
+            while len(self._conflicts) > self.max_oids:
+                self._conflicts.popitem(last=False)
+            return count
+
+    def getConflictCount(self, oid):
+        """
+        How many recent conflicts have been seen for *oid*.
+        """
+        with self._lock:
+            count, last = self._conflicts.get(oid, (0, None))
+        if last is None or time.time() - last > self.window:
+            return 0
+        return count
+
+    def getRetryDelay(self, attempt, exception, job_name=None):
+        oid = getattr(exception, 'oid', None)
+        recent = self._record_conflict(oid, time.time()) if oid is not None else 0
+        return self.random.uniform(0, self._ceiling(attempt - 1 + recent))
+
+
+class SiteJobSession(object):
+    """
+    Runs many jobs, one after the other, using the same database
+    connection.
+
+    Each call to :meth:`run_job_in_site` is like calling
+    :func:`run_job_in_site`: the job runs in its own transaction, with
+    its own retries. But instead of opening a connection for each job
+    (and warming up its cache again), the connection opened by
+    :meth:`open` is used until :meth:`close` is called. The main
+    application folder is also only looked up once.
+
+    This can be used as a context manager::
+
+        with SiteJobSession() as session:
+            for item in work:
+                session.run_job_in_site(functools.partial(process, item))
+
+    A session, like a connection, must only be used by one thread at a
+    time, and must not be used while a transaction is in progress.
+
+    .. versionadded:: 3.1.0
+    """
+
+    #: The open connection, or None.
+    connection = None
+    #: The main application folder, once a job has looked it up.
+    root_folder = None
+
+    def __init__(self, root_folder_name=u'nti.dataserver', db=None):
+        """
+        :keyword str root_folder_name: See :func:`run_job_in_site`.
+        :keyword db: The :class:`ZODB.interfaces.IDatabase` to open. If
+            not given, the registered utility is used.
+        """
+        self.root_folder_name = root_folder_name
+        self.db = db
+
+    def open(self):
+        """
+        Open the connection, if it isn't already.
+        """
+        if self.connection is not None:
+            return
+        db = self.db if self.db is not None else component.getUtility(IDatabase)
+        # Just like _RunJobInSite, open the connection while the
+        # transaction manager is in explicit mode.
+        txm = transaction.manager.manager
+        was_explicit = txm.explicit
+        txm.explicit = True
+        try:
+            self.connection = db.open()
+        finally:
+            txm.explicit = was_explicit
+
+    def close(self):
+        """
+        Close the connection, if it's open.
+        """
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            finally:
+                self.connection = None
+                self.root_folder = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.close()
+
+    def run_job_in_site(self,
+                        func,
+                        retries=0,
+                        sleep=None,
+                        site_names=_marker,
+                        job_name=None,
+                        side_effect_free=False,
+                        retry_policy=None,
+                        prefetch=None,
+                        deadline=None):
+        """
+        Run *func* in its own transaction, using this session's
+        connection. The arguments are as for :func:`run_job_in_site`.
+        """
+        if site_names is not _marker:
+            warnings.warn("site_names is deprecated. "
+                          "Call this already in the appropriate site",
+                          FutureWarning)
+        else:
+            site_names = get_possible_site_names()
+        self.open()
+        return _RunJobInSite(
+            func,
+            retries=retries,
+            sleep=sleep,
+            site_names=site_names,
+            job_name=job_name,
+            side_effect_free=side_effect_free,
+            root_folder_name=self.root_folder_name,
+            session=self,
+            retry_policy=retry_policy,
+            prefetch=prefetch,
+            deadline=deadline,
+        )()
+
+
+def _get_submitter_site():
+    # Return (site_names, host_site_name) to find the current site
+    # again in another thread.
+    site = getSite()
+    if IHostPolicyFolder.providedBy(site) and getattr(site, '_p_jar', None) is not None:
+        return None, site.__name__
+    return get_possible_site_names(), None
+
+
+def _get_affinity_key(site_names, host_site_name):
+    # The name jobs are routed by: the host site, or else the
+    # first (most specific) of the possible site names.
+    if host_site_name is not None:
+        return host_site_name
+    return site_names[0] if site_names else u''
+
+
+class SiteExecutor(Executor):
+    """
+    A :class:`concurrent.futures.Executor` that runs each submitted
+    callable in its own transaction, in the site that was current when
+    it was submitted, on a bounded pool of threads.
+
+    Each callable is run as if by :func:`run_job_in_site`, with the
+    *retries*, *sleep*, *side_effect_free*, *retry_policy* and
+    *root_folder_name* given to the constructor. Each worker thread
+    keeps its own connection open (see :class:`SiteJobSession`) for all
+    the jobs it runs; the connections are closed when the workers exit
+    after :meth:`shutdown`.
+
+    If the current site is a persistent host site, the job runs in that
+    same site. Otherwise, like :func:`run_job_in_site`, the site is
+    found from :func:`get_possible_site_names` (called in the submitting
+    thread).
+
+    Jobs are routed to workers by a stable hash of the site name (see
+    :func:`~nti.site.hostpolicy.get_host_site_shard`), so the jobs of
+    one site usually run on the same connection, and each connection's
+    cache only holds the objects of a subset of the sites. When a
+    worker has nothing of its own to do, it takes the most recently
+    queued job of the busiest other worker.
+
+    For :mod:`asyncio` callers, :meth:`submit_async` returns an
+    awaitable instead of a future.
+
+    .. versionadded:: 3.1.0
+    """
+
+    def __init__(self,
+                 max_workers=None,
+                 retries=0,
+                 sleep=None,
+                 side_effect_free=False,
+                 retry_policy=None,
+                 root_folder_name=u'nti.dataserver',
+                 db=None):
+        if max_workers is None:
+            # The same default as ThreadPoolExecutor in Python 3.8+
+            max_workers = min(32, multiprocessing.cpu_count() + 4)
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0")
+        self._loop_kwargs = dict(
+            retries=retries,
+            sleep=sleep,
+            job_name=None,
+            side_effect_free=side_effect_free,
+            retry_policy=retry_policy,
+            root_folder_name=root_folder_name,
+        )
+        self._root_folder_name = root_folder_name
+        self._db = db
+        self._shutdown = False
+        self._lock = threading.Lock()
+        # One queue for each worker; each worker waits on its own
+        # condition so that it can be woken for its own jobs.
+        self._queues = [deque() for _ in range(max_workers)]
+        self._conditions = [threading.Condition(self._lock) for _ in range(max_workers)]
+        self._idle = set()
+        #: How many jobs have been run by a worker other than the one
+        #: they were routed to.
+        self.steals = 0
+        self._threads = []
+        for index in range(max_workers):
+            thread = threading.Thread(target=self._work,
+                                      args=(index,),
+                                      name='SiteExecutor-%d' % (index,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_work(self, index):
+        with self._lock:
+            while True:
+                queue = self._queues[index]
+                if queue:
+                    return queue.popleft()
+                victim = max(self._queues, key=len)
+                if victim:
+                    self.steals += 1
+                    return victim.pop()
+                if self._shutdown:
+                    return None
+                self._idle.add(index)
+                try:
+                    self._conditions[index].wait()
+                finally:
+                    self._idle.discard(index)
+
+    def _work(self, index):
+        session = SiteJobSession(self._root_folder_name, self._db)
+        try:
+            while True:
+                work = self._next_work(index)
+                if work is None:
+                    break
+                future, fn, site_names, host_site_name, args, kwargs = work
+                del work
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    session.open()
+                    result = _RunJobInSite(fn,
+                                           site_names=site_names,
+                                           host_site_name=host_site_name,
+                                           session=session,
+                                           **self._loop_kwargs)(*args, **kwargs)
+                except BaseException as e: # pylint:disable=broad-except
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                del future, fn, args, kwargs
+        finally:
+            session.close()
+
+    def submit(self, fn, *args, **kwargs): # pylint:disable=arguments-differ
+        site_names, host_site_name = _get_submitter_site()
+        index = get_host_site_shard(_get_affinity_key(site_names, host_site_name),
+                                    len(self._queues))
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self._queues[index].append((future, fn, site_names, host_site_name,
+                                        args, kwargs))
+            if index in self._idle or not self._idle:
+                self._conditions[index].notify()
+            else:
+                # The worker is busy; let an idle one take the job.
+                self._conditions[next(iter(self._idle))].notify()
+        return future
+
+    def submit_async(self, fn, *args, **kwargs):
+        """
+        Like :meth:`submit`, but return an :mod:`asyncio` future for the
+        result, attached to the current event loop.
+        """
+        import asyncio # Not on Python 2
+        return asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True): # pylint:disable=arguments-differ
+        # Queued jobs are still run.
+        with self._lock:
+            self._shutdown = True
+            for condition in self._conditions:
+                condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+#: The outcome of running one job of a batch with
+#: :func:`run_jobs_in_site_batch`. Exactly one of *result* or
+#: *exception* is meaningful; *exception* is None if the job succeeded.
+BatchJobResult = namedtuple('BatchJobResult', ('result', 'exception'))
+
+
+def _run_batch_handler(funcs):
+    results = []
+    for func in funcs:
+        savepoint = transaction.savepoint()
+        try:
+            result = func()
+        except TransientError:
+            # Let the whole batch be retried.
+            raise
+        except Exception as e: # pylint:disable=broad-except
+            savepoint.rollback()
+            results.append(BatchJobResult(None, e))
+        else:
+            results.append(BatchJobResult(result, None))
+    return results
+
+
+def _run_job_batch(funcs, loop_kwargs):
+    try:
+        return _RunJobInSite(functools.partial(_run_batch_handler, funcs),
+                             **loop_kwargs)()
+    except Exception as e: # pylint:disable=broad-except
+        if len(funcs) == 1:
+            logger.exception("Failed to run job %s", funcs[0])
+            return [BatchJobResult(None, e)]
+        logger.debug("Batch of %d jobs failed (%r); splitting it", len(funcs), e)
+        middle = len(funcs) // 2
+        return (_run_job_batch(funcs[:middle], loop_kwargs)
+                + _run_job_batch(funcs[middle:], loop_kwargs))
+
+
+def run_jobs_in_site_batch(funcs,
+                           batch_size=100,
+                           retries=0,
+                           sleep=None,
+                           job_name=None,
+                           root_folder_name=u'nti.dataserver',
+                           host_site_name=None,
+                           retry_policy=None):
+    """
+    Run many small jobs, committing groups of them together.
+
+    The callables in *funcs* are split into batches of *batch_size*,
+    and each batch is run in one transaction, as if by
+    :func:`run_job_in_site` (in the current site, or in the persistent
+    host site named *host_site_name*, with the given *retries*,
+    *sleep*, *retry_policy* and *root_folder_name*). Each job gets a
+    savepoint of its own. If a job raises an exception, its changes
+    are rolled back to that savepoint and the rest of the batch
+    continues; if it raises a :class:`transaction.interfaces.TransientError`,
+    the whole batch is retried.
+
+    If the batch still can't be committed (for example, it keeps
+    conflicting), it is split in half and each half is run the same
+    way, until the jobs responsible are run, and fail, alone.
+
+    :return: A list of :class:`BatchJobResult`, one for each callable in
+        *funcs*, in order.
+
+    .. versionadded:: 3.1.0
+    """
+    funcs = list(funcs)
+    loop_kwargs = dict(
+        retries=retries,
+        sleep=sleep,
+        site_names=get_possible_site_names(),
+        host_site_name=host_site_name,
+        job_name=job_name or u'run_jobs_in_site_batch',
+        side_effect_free=False,
+        root_folder_name=root_folder_name,
+        retry_policy=retry_policy,
+    )
+    results = []
+    for i in range(0, len(funcs), batch_size):
+        results.extend(_run_job_batch(funcs[i:i + batch_size], loop_kwargs))
+    return results
+
+
+#: The outcome of running a job in one host site. Exactly one of
+#: *result* or *exception* is meaningful; *exception* is None
+#: if the job succeeded.
+HostSiteJobResult = namedtuple('HostSiteJobResult',
+                               ('site_name', 'result', 'exception'))
+
+
+def _run_job_in_named_host_site(func, site_name, loop_kwargs):
+    # Module level so that it can be pickled for process pools.
+    return _RunJobInSite(func, host_site_name=site_name, **loop_kwargs)()
+
+
+def _plan_host_site_jobs(checkpoint, by_level, filters):
+    if checkpoint:
+        predicate = filters.get('predicate')
+        def not_done(site):
+            if site.hasJobCheckpoint(checkpoint):
+                return False
+            return predicate is None or predicate(site)
+        filters['predicate'] = not_done
+    if by_level:
+        return get_all_host_site_levels(**filters)
+    # Everything in one "level", in top-down order. This doesn't
+    # need to examine the sites outside the shard.
+    return [[site.__name__ for site in iter_all_host_sites(**filters)]]
+
+
+def _get_host_site_job_plan(checkpoint, root_folder_name, by_level=False, before=None,
+                            **filters):
+    # The levels of site names still to run, determined in a transaction
+    # of their own.
+    return _RunJobInSite(functools.partial(_plan_host_site_jobs,
+                                           checkpoint, by_level, filters),
+                         site_names=None,
+                         job_name=None,
+                         side_effect_free=True,
+                         root_folder_name=root_folder_name,
+                         before=before)()
+
+
+def _host_site_job_kwargs(checkpoint, snapshot, **kwargs):
+    if checkpoint and snapshot:
+        raise ValueError("A snapshot cannot record a checkpoint")
+    if checkpoint and kwargs.get('side_effect_free'):
+        raise ValueError("A side-effect free job cannot record a checkpoint")
+    kwargs['site_names'] = None
+    kwargs['checkpoint'] = checkpoint
+    kwargs['before'] = _snapshot_before(snapshot)
+    return kwargs
+
+
+def _host_site_job_result(func, site_name, get_result):
+    try:
+        return HostSiteJobResult(site_name, get_result(), None)
+    except Exception as e: # pylint:disable=broad-except
+        logger.exception("Failed to run job %s in site %s", func, site_name)
+        return HostSiteJobResult(site_name, None, e)
+
+
+def run_job_in_all_host_sites_sequential(func,
+                                         checkpoint=None,
+                                         shard_index=None,
+                                         shard_count=None,
+                                         predicate=None,
+                                         retries=0,
+                                         sleep=None,
+                                         job_name=None,
+                                         side_effect_free=False,
+                                         root_folder_name=u'nti.dataserver',
+                                         snapshot=None):
+    """
+    Run *func* once in each persistent host site, top-down, each in a
+    transaction of its own.
+
+    Unlike :func:`nti.site.hostpolicy.run_job_in_all_host_sites`, this
+    must *not* be called while a transaction is in progress. Each site
+    is run as if by :func:`run_job_in_site`, with its own transaction
+    (and the given *retries*, *sleep*, *job_name*, *side_effect_free*
+    and *root_folder_name*), and with that host site current. A
+    failure in one site aborts only the work done in that site.
+
+    :keyword str checkpoint: If given, the name of a persistent
+        checkpoint. Each site in which the job succeeds records that it
+        reached the checkpoint (see
+        :meth:`~.HostPolicyFolder.addJobCheckpoint`) as part of that
+        site's transaction, and sites that have already reached it are
+        skipped. Running the job again with the same checkpoint thus
+        resumes where it stopped. Because each site records its own
+        checkpoints, sites committing at the same time don't conflict.
+        Use :meth:`~.HostSitesFolder.removeJobCheckpoint` to start
+        over. This cannot be used with *side_effect_free*, which might
+        not commit the checkpoint.
+    :keyword shard_index: See :func:`~nti.site.hostpolicy.iter_all_host_sites`.
+    :keyword shard_count: See :func:`~nti.site.hostpolicy.iter_all_host_sites`.
+        Independent processes can each run one shard of the same job.
+    :keyword predicate: See :func:`~nti.site.hostpolicy.iter_all_host_sites`.
+        This is called in a separate transaction before any site is run.
+    :keyword snapshot: If given, every connection used by the job,
+        including the one that finds the sites, sees the same state of
+        the database, as described for :func:`run_job_in_site`. The job
+        is then read-only and cannot use a *checkpoint*.
+    :return: A list of :class:`HostSiteJobResult`, one for each
+        site that was run, in top-down order. Exceptions raised in a site
+        are captured there and do not prevent other sites (including that
+        site's children) from running.
+
+    .. versionadded:: 3.1.0
+    """
+    loop_kwargs = _host_site_job_kwargs(
+        checkpoint, snapshot,
+        retries=retries,
+        sleep=sleep,
+        job_name=job_name,
+        side_effect_free=side_effect_free,
+        root_folder_name=root_folder_name,
+    )
+    levels = _get_host_site_job_plan(checkpoint, root_folder_name,
+                                     before=loop_kwargs['before'],
+                                     shard_index=shard_index,
+                                     shard_count=shard_count,
+                                     predicate=predicate)
+    results = []
+    for level in levels:
+        for site_name in level:
+            results.append(_host_site_job_result(
+                func, site_name,
+                functools.partial(_run_job_in_named_host_site,
+                                  func, site_name, loop_kwargs)))
+    return results
+
+
+def run_job_in_all_host_sites_parallel(func,
+                                       max_workers=None,
+                                       executor=None,
+                                       checkpoint=None,
+                                       shard_index=None,
+                                       shard_count=None,
+                                       predicate=None,
+                                       retries=0,
+                                       sleep=None,
+                                       job_name=None,
+                                       side_effect_free=False,
+                                       root_folder_name=u'nti.dataserver',
+                                       snapshot=None):
+    """
+    Like :func:`run_job_in_all_host_sites_sequential`, but run the sites
+    at the same depth of the hierarchy concurrently.
+
+    All the sites of one level (see
+    :func:`~nti.site.hostpolicy.get_all_host_site_levels`) finish before
+    any site of the next level starts, so parent sites are always
+    done before their children.
+
+    :keyword int max_workers: The size of the thread pool to create
+        if no *executor* is given.
+    :keyword executor: A :class:`concurrent.futures.Executor` to
+        submit jobs to. It is not shut down. If this is a process
+        pool, *func* must be picklable, and each process must have
+        its own :class:`ZODB.interfaces.IDatabase` utility registered.
+
+    .. versionadded:: 3.1.0
+    """
+    loop_kwargs = _host_site_job_kwargs(
+        checkpoint, snapshot,
+        retries=retries,
+        sleep=sleep,
+        job_name=job_name,
+        side_effect_free=side_effect_free,
+        root_folder_name=root_folder_name,
+    )
+    levels = _get_host_site_job_plan(checkpoint, root_folder_name,
+                                     by_level=True,
+                                     before=loop_kwargs['before'],
+                                     shard_index=shard_index,
+                                     shard_count=shard_count,
+                                     predicate=predicate)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers)
+
+    results = []
+    try:
+        for level in levels:
+            futures = [
+                (site_name, executor.submit(_run_job_in_named_host_site,
+                                            func, site_name, loop_kwargs))
+                for site_name in level
+            ]
+            for site_name, future in futures:
+                results.append(_host_site_job_result(func, site_name, future.result))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return results
+
+
+def _install_host_site_names(specs):
+    return [site.__name__ for site in install_host_sites(specs)]
+
+
+def provision_host_sites(manifest,
+                         chunk_size=100,
+                         retries=0,
+                         root_folder_name=u'nti.dataserver'):
+    """
+    Create many persistent host sites, committing as we go.
+
+    This must *not* be called in a transaction. The manifest is split
+    into chunks of *chunk_size* sites, parents before children, and each
+    chunk is installed by :func:`~nti.site.hostpolicy.install_host_sites`
+    in its own transaction, retried *retries* times, with the main
+    application folder found at *root_folder_name* as the current site.
+
+    :param manifest: Either a sequence of
+        :class:`~nti.site.hostpolicy.HostSiteSpec`, or a path or open
+        file to read with :func:`~nti.site.hostpolicy.read_host_site_manifest`.
+    :return: The names of the sites that were created.
+
+    .. versionadded:: 3.1.0
+    """
+    if isinstance(manifest, string_types) or hasattr(manifest, 'read'):
+        manifest = read_host_site_manifest(manifest)
+    specs = order_host_site_specs(manifest)
+
+    names = []
+    for i in range(0, len(specs), chunk_size):
+        chunk = specs[i:i + chunk_size]
+        created = _RunJobInSite(
+            functools.partial(_install_host_site_names, chunk),
+            retries=retries,
+            site_names=None,
+            job_name='provision_host_sites %s-%s' % (i, i + len(chunk)),
+            side_effect_free=False,
+            root_folder_name=root_folder_name)()
+        names.extend(created)
+    return names
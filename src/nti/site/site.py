@@ -101,6 +101,10 @@ def get_site_for_site_names(site_names, site=None):
     .. versionchanged:: 1.3.0
         Prioritize :class:`ISiteMapping` so that persistent sites can be mapped
         to other persistent sites.
+    .. versionchanged:: 3.1.0
+        If the host sites folder creates sites lazily, create the missing
+        persistent site, or use a transient one if the transaction cannot
+        write. See :func:`nti.site.hostpolicy.get_lazy_host_site`.
     """
 
     if site is None:
@@ -123,6 +127,13 @@ def get_site_for_site_names(site_names, site=None):
             pers_site = site[u'++etc++hostsites'][site_name]
             site = pers_site
         except (KeyError, TypeError):
+            # Are we supposed to create it now?
+            # (Circular import)
+            from nti.site.hostpolicy import get_lazy_host_site
+            lazy_site = get_lazy_host_site(site, site_components)
+            if lazy_site is not None:
+                return lazy_site
+
             # No, nothing persistent, dummy one up.
             # Note that this code path is deprecated now and not
             # expected to be hit.
@@ -39,6 +39,7 @@ from zope.site.interfaces import INewLocalSite
 
 from zope.traversing.interfaces import IBeforeTraverseEvent
 
+from nti.site.interfaces import IHostSitesFolder
 from nti.site.interfaces import IHostPolicyFolder
 from nti.site.interfaces import IMainApplicationFolder
 
@@ -198,12 +199,19 @@ def new_local_site_dispatcher(event):
 
 
 @component.adapter(IHostPolicyFolder, IObjectRemovedEvent)
-def _on_site_removed(site, unused_event=None):
+def _on_site_removed(site, event=None):
     """
     Unregister the ``IBaseComponents`` for a removed site.
+
     .. versionadded:: 1.4.0
+    .. versionchanged:: 3.1.0
+       Also remove the site from the child index of the
+       :class:`~.HostSitesFolder` it was removed from.
     """
     name = site.__name__
+    sites = getattr(event, 'oldParent', None)
+    if IHostSitesFolder.providedBy(sites):
+        sites.unindexSite(getattr(event, 'oldName', None) or name)
     site_components = component.queryUtility(IComponents, name=name)
     if site_components is not None:
         unregisterUtility(component.getSiteManager(),
@@ -5,6 +5,12 @@ from __future__ import print_function, absolute_import, division
 
 __docformat__ = "restructuredtext en"
 
+from contextlib import contextmanager
+
+from zope import component
+
+from ZODB.interfaces import IDatabase
+
 from nti.testing import zodb
 
 from .. import testing
@@ -16,3 +22,18 @@ reset_db_caches = zodb.reset_db_caches # BWC, remove in 2021
 WithMockDS = testing.uses_independent_db_site # BWC, remove in 2021
 SharedConfiguringTestLayer = testing.SharedConfiguringTestLayer # BWC, remove in 2021
 SiteTestCase = testing.SiteTestCase # BWC, remove in 2021
+
+
+@contextmanager
+def registered_database(db):
+    """
+    Register *db* as the global :class:`ZODB.interfaces.IDatabase`
+    utility, which :func:`nti.site.runner.run_job_in_site` opens its
+    connections from, for the duration of the block.
+    """
+    gsm = component.getGlobalSiteManager()
+    gsm.registerUtility(db, IDatabase)
+    try:
+        yield db
+    finally:
+        gsm.unregisterUtility(db, IDatabase)
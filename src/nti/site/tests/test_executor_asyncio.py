@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for using the :class:`nti.site.runner.SiteExecutor` from
+:mod:`asyncio`.
+
+These are separate so that the other executor tests still run where
+there is no :mod:`asyncio`, and they avoid ``async`` syntax so that
+this module can be imported everywhere.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import unittest
+
+try:
+    import asyncio
+except ImportError: # Python 2
+    asyncio = None
+
+from zope.component.hooks import getSite
+
+from nti.site.runner import SiteExecutor
+
+from nti.site.testing import uses_independent_db_site as WithMockDS
+
+from nti.site.tests import SharedConfiguringTestLayer
+from nti.site.tests import registered_database
+
+
+@unittest.skipIf(asyncio is None, "Requires asyncio")
+class TestSiteExecutorAsyncio(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    @WithMockDS
+    def test_submit_async(self):
+        def site_name():
+            return getSite().__name__
+
+        executor = SiteExecutor(max_workers=1)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        with registered_database(self.db):
+            try:
+                name = loop.run_until_complete(executor.submit_async(site_name))
+                # No site, so the main application folder.
+                assert_that(name, is_('dataserver2'))
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+                executor.shutdown()
@@ -13,14 +13,23 @@ logger = __import__('logging').getLogger(__name__)
 
 from hamcrest import assert_that
 from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import not_none
+from hamcrest import none
+from hamcrest import is_in
+from hamcrest import is_not
+from hamcrest import same_instance
 
 
 from nti.testing import base
 
 import six
+import unittest
 import transaction
 
 from zope import component
+from zope import interface
+from zope.interface.interfaces import IComponents
 from ZODB.interfaces import IDatabase
 
 import ZODB.DB
@@ -29,12 +38,35 @@ from zope.site import SiteManagerContainer
 
 
 from ..runner import run_job_in_site
+from ..runner import SiteJobSession
+from ..runner import run_jobs_in_site_batch
+from ..runner import ConflictAwareRetryPolicy
+from ..runner import ExponentialBackoffRetryPolicy
+from ..runner import SiteJobMetricsCollector
+from ..runner import check_deadline
+from ..runner import get_remaining_time
+from ..runner import iter_in_bounded_memory
 from ..runner import _tx_string
+from ..runner import SiteExecutor
+
+from ..hostpolicy import synchronize_host_policies
+from ..hostpolicy import get_host_site_shard
+
+from ..testing import uses_independent_db_site as WithMockDS
+from ..testing import persistent_site_trans as mock_db_trans
 
 from ..transient import TrivialSite
 
 from ..interfaces import SiteNotInstalledError
 
+from . import SharedConfiguringTestLayer
+from . import registered_database
+from .test_sync import BASE
+from .test_sync import DEMO
+from .test_sync import EVAL
+from .test_sync import EVALALPHA
+from .test_sync import _SITES
+
 
 class TestRunner(base.AbstractTestBase):
 
@@ -139,3 +171,610 @@ class TestRunner(base.AbstractTestBase):
 
 
         run_job_in_site(Callable())
+
+    def test_session_reuses_connection(self):
+        from ZODB.POSException import ConflictError
+        from zope.component.hooks import getSite
+        sites = []
+        def func():
+            sites.append(getSite())
+            if len(sites) == 2:
+                raise ConflictError()
+            return len(sites)
+
+        with SiteJobSession() as session:
+            conn = session.connection
+            assert_that(conn.explicit_transactions, is_(True))
+            assert_that(session.run_job_in_site(func), is_(1))
+            assert_that(session.run_job_in_site(func, retries=1), is_(3))
+            assert_that(session.connection, is_(conn))
+            assert_that(session.root_folder, is_(conn.root()['nti.dataserver']))
+
+        assert_that(session.connection, is_(None))
+        assert_that(conn.opened, is_(None))
+        # The same object, loaded once, was used each time.
+        assert_that(sites, has_length(3))
+        assert_that(set(id(x) for x in sites), is_(set([id(sites[0])])))
+
+    def test_read_only(self):
+        from ZODB.POSException import ReadOnlyHistoryError
+        from persistent.mapping import PersistentMapping
+        from zope.component.hooks import getSite
+        db = component.getUtility(IDatabase)
+        conn = db.open()
+        conn.root()[u'nti.dataserver'].data = PersistentMapping(a=1)
+        conn.root()._p_changed = True
+        transaction.commit()
+        conn.close()
+
+        jars = []
+        def read():
+            jars.append(getSite().data._p_jar)
+            return getSite().data['a']
+
+        def write():
+            getSite().data['a'] = 2
+            raise AssertionError("Not reached")
+
+        assert_that(run_job_in_site(read, read_only=True), is_(1))
+        with self.assertRaises(ReadOnlyHistoryError):
+            run_job_in_site(write, read_only=True, retries=2)
+        # The change was discarded from the pooled connection.
+        assert_that(run_job_in_site(read, read_only=True), is_(1))
+        # Which is a normal connection, reused with its cache, and
+        # usable for writing again.
+        assert_that(jars[0].before, is_(none()))
+        assert_that(jars[1], is_(same_instance(jars[0])))
+        assert_that('register', is_not(is_in(vars(jars[0]))))
+
+    def test_batch(self):
+        from persistent.mapping import PersistentMapping
+        from zope.component.hooks import getSite
+        from ZODB.POSException import ConflictError
+        db = component.getUtility(IDatabase)
+        conn = db.open()
+        conn.root()[u'nti.dataserver'].data = PersistentMapping()
+        conn.root()._p_changed = True
+        transaction.commit()
+        conn.close()
+
+        calls = []
+        def job(i):
+            def func():
+                calls.append(i)
+                getSite().data[i] = i
+                if i == 3:
+                    raise ValueError(i)
+                if i == 6:
+                    raise ConflictError()
+                return i
+            return func
+
+        results = run_jobs_in_site_batch([job(i) for i in range(8)], batch_size=4)
+        assert_that([r.result for r in results],
+                    is_([0, 1, 2, None, 4, 5, None, 7]))
+        assert_that(results[3].exception, is_(ValueError))
+        assert_that(results[6].exception, is_(ConflictError))
+        # The first batch ran once; the second was split until the
+        # conflicting job was alone.
+        assert_that(calls, is_([0, 1, 2, 3,
+                                4, 5, 6,
+                                4, 5,
+                                6,
+                                6, 7]))
+
+        conn = db.open()
+        assert_that(sorted(conn.root()[u'nti.dataserver'].data),
+                    is_([0, 1, 2, 4, 5, 7]))
+        conn.close()
+
+    def test_retry_policy(self):
+        from ZODB.POSException import ConflictError
+        from nti.transactions.interfaces import IWillSleepBetweenAttempts
+        from ..interfaces import IRetryPolicy
+
+        @interface.implementer(IRetryPolicy)
+        class Policy(object):
+            def __init__(self):
+                self.calls = []
+            def getRetryDelay(self, attempt, exception, job_name=None):
+                self.calls.append((attempt, type(exception), job_name))
+                return 0.001 * attempt
+
+        slept = []
+        def on_sleep(event):
+            slept.append(event.sleep_time)
+        component.provideHandler(on_sleep, (IWillSleepBetweenAttempts,))
+
+        attempts = []
+        def func():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConflictError()
+            return 42
+
+        policy = Policy()
+        result = run_job_in_site(func, retries=2, retry_policy=policy, job_name='job')
+        assert_that(result, is_(42))
+        assert_that(policy.calls, is_([(1, ConflictError, 'job'),
+                                       (2, ConflictError, 'job')]))
+        assert_that(slept, is_([0.001, 0.002]))
+
+        # Running out of attempts doesn't ask for a delay.
+        del attempts[:]
+        del slept[:]
+        policy = Policy()
+        with self.assertRaises(ConflictError):
+            run_job_in_site(func, retries=1, retry_policy=policy, job_name='job')
+        assert_that(policy.calls, is_([(1, ConflictError, 'job')]))
+        assert_that(slept, is_([0.001]))
+
+        # A registered policy is used by default
+        del attempts[:]
+        del slept[:]
+        policy = Policy()
+        component.provideUtility(policy, IRetryPolicy)
+        try:
+            assert_that(run_job_in_site(func, retries=2), is_(42))
+            assert_that(policy.calls, has_length(2))
+            # But not when a fixed sleep is given
+            del attempts[:]
+            run_job_in_site(func, retries=2, sleep=0.0001)
+            assert_that(policy.calls, has_length(2))
+        finally:
+            component.getGlobalSiteManager().unregisterUtility(policy, IRetryPolicy)
+            component.getGlobalSiteManager().unregisterHandler(
+                on_sleep, (IWillSleepBetweenAttempts,))
+
+    def test_backoff_policies(self):
+        from ZODB.POSException import ConflictError
+        class Random(object):
+            # Always the largest delay
+            @staticmethod
+            def uniform(_a, b):
+                return b
+
+        policy = ExponentialBackoffRetryPolicy(base=1, cap=10)
+        policy.random = Random()
+        assert_that([policy.getRetryDelay(i, ConflictError()) for i in range(1, 7)],
+                    is_([1, 2, 4, 8, 10, 10]))
+
+        policy = ConflictAwareRetryPolicy(base=1, cap=100, max_oids=2)
+        policy.random = Random()
+        hot = ConflictError(oid=b'hot00000')
+        cold = ConflictError(oid=b'cold0000')
+        # Each new conflict on the same object backs off further.
+        assert_that(policy.getRetryDelay(1, hot), is_(1))
+        assert_that(policy.getRetryDelay(1, hot), is_(2))
+        assert_that(policy.getRetryDelay(1, hot), is_(4))
+        assert_that(policy.getConflictCount(b'hot00000'), is_(3))
+        assert_that(policy.getRetryDelay(1, cold), is_(1))
+        assert_that(policy.getRetryDelay(2, ConflictError()), is_(2))
+        # Only recent conflicts count
+        policy.window = -1
+        assert_that(policy.getConflictCount(b'hot00000'), is_(0))
+        assert_that(policy.getRetryDelay(1, hot), is_(1))
+        # Old objects are forgotten
+        policy.window = 10
+        policy.getRetryDelay(1, ConflictError(oid=b'other000'))
+        assert_that(policy.getConflictCount(b'cold0000'), is_(0))
+
+    def test_metrics(self):
+        from persistent.mapping import PersistentMapping
+        from zope.component.hooks import getSite
+        from ZODB.POSException import ConflictError
+        from ..interfaces import ISiteJobFinishedEvent
+
+        db = component.getUtility(IDatabase)
+        conn = db.open()
+        conn.root()[u'nti.dataserver'].data = PersistentMapping()
+        conn.root()._p_changed = True
+        transaction.commit()
+        conn.close()
+
+        collector = SiteJobMetricsCollector()
+        events = []
+        component.provideHandler(collector, (ISiteJobFinishedEvent,))
+        component.provideHandler(events.append, (ISiteJobFinishedEvent,))
+
+        attempts = []
+        def store():
+            attempts.append(1)
+            getSite().data['a'] = len(attempts)
+            if len(attempts) == 1:
+                raise ConflictError()
+
+        def fail():
+            raise ValueError()
+
+        try:
+            run_job_in_site(store, retries=1)
+            run_job_in_site(lambda: getSite().data['a'], job_name='read')
+            run_job_in_site(lambda: None, job_name='read')
+            with self.assertRaises(ValueError):
+                run_job_in_site(fail)
+        finally:
+            gsm = component.getGlobalSiteManager()
+            gsm.unregisterHandler(collector, (ISiteJobFinishedEvent,))
+            gsm.unregisterHandler(events.append, (ISiteJobFinishedEvent,))
+
+        metrics = events[0].metrics
+        assert_that(metrics.job_name, is_('store'))
+        assert_that(metrics.succeeded, is_(True))
+        assert_that(metrics.attempts, is_(2))
+        assert_that(metrics.retry_exceptions, is_(['ConflictError']))
+        assert_that(metrics.stores, is_(1))
+        assert_that(metrics.duration >= metrics.handler_time, is_(True))
+
+        assert_that(events[1].metrics.loads, is_(0)) # Still cached
+        assert_that(events[3].metrics.exception_type, is_('ValueError'))
+
+        read = collector.getStatistics('read')
+        assert_that(read.count, is_(2))
+        assert_that(read.attempts, is_(2))
+        assert_that(collector.getStatistics('store').retry_exceptions,
+                    is_({'ConflictError': 1}))
+        assert_that(collector.getStatistics('fail').failures, is_(1))
+        assert_that(collector.getMostExpensive(1, key='count')[0].job_name,
+                    is_('read'))
+        assert_that(collector.getAllStatistics(), has_length(3))
+        collector.clear()
+        assert_that(collector.getAllStatistics(), is_([]))
+
+    def test_prefetch(self):
+        from persistent.mapping import PersistentMapping
+        from zope.site.folder import Folder
+        from ZODB.POSException import ConflictError
+        db = component.getUtility(IDatabase)
+        conn = db.open()
+        site = conn.root()[u'nti.dataserver'] = Folder()
+        site.setSiteManager(component.getGlobalSiteManager())
+        site['users'] = Folder()
+        site['users']['bob'] = Folder()
+        site['other'] = Folder()
+        transaction.commit()
+        oids = dict(site=site._p_oid,
+                    users=site['users']._p_oid,
+                    bob=site['users']['bob']._p_oid,
+                    other=site['other']._p_oid)
+        conn.close()
+
+        with SiteJobSession() as session:
+            calls = []
+            def prefetch(objects):
+                calls.append([getattr(x, '_p_oid', x) for x in objects])
+            session.connection.prefetch = prefetch
+
+            attempts = []
+            def func():
+                attempts.append(1)
+                session.connection.cacheMinimize()
+                if len(attempts) == 2:
+                    raise ConflictError()
+            session.run_job_in_site(func)
+            assert_that(calls, is_([]))
+            session.run_job_in_site(
+                func,
+                prefetch=[oids['other'], u'users/bob', u'missing/x'],
+                retries=1)
+
+        # Each attempt: the OID (the site itself has already been
+        # loaded), then the paths one level at a time.
+        one_attempt = [
+            [oids['other']],
+            [oids['users']],
+            [oids['bob']],
+        ]
+        assert_that(calls, is_(one_attempt + one_attempt))
+
+    def test_iter_in_bounded_memory(self):
+        from persistent.mapping import PersistentMapping
+        from persistent.interfaces import GHOST
+        from zope.component.hooks import getSite
+        from BTrees.OOBTree import OOBTree
+        from zope.site.folder import Folder
+        db = component.getUtility(IDatabase)
+        conn = db.open()
+        site = conn.root()[u'nti.dataserver'] = Folder()
+        site.setSiteManager(component.getGlobalSiteManager())
+        tree = site.data = OOBTree()
+        for i in range(10):
+            tree[i] = PersistentMapping()
+        transaction.commit()
+        conn.close()
+
+        savepoints = []
+        states = []
+        def func():
+            txn = transaction.get()
+            real_savepoint = txn.savepoint
+            def savepoint(optimistic=False):
+                savepoints.append(optimistic)
+                return real_savepoint(optimistic)
+            txn.savepoint = savepoint
+            items = list(getSite().data.values())
+            for i, mapping in enumerate(iter_in_bounded_memory(items,
+                                                                savepoint_interval=4,
+                                                                gc_interval=3)):
+                if i % 2:
+                    mapping['changed'] = True
+                else:
+                    mapping.get('changed')
+            states.extend(mapping._p_state for mapping in items)
+        run_job_in_site(func)
+        assert_that(savepoints, is_([True, True]))
+        # Unchanged items were ghosted right away; changed ones after
+        # a savepoint. The last two changed since the last savepoint.
+        assert_that(states, is_([GHOST] * 8 + [GHOST, 1]))
+
+        conn = db.open()
+        tree = conn.root()[u'nti.dataserver'].data
+        assert_that([i for i in tree if tree[i].get('changed')],
+                    is_([1, 3, 5, 7, 9]))
+        conn.close()
+
+    def test_profiler(self):
+        import os
+        import pstats
+        import shutil
+        import tempfile
+        from ..interfaces import ISiteJobProfiler
+        from ..runner import SiteJobProfiler
+        from ..runner import _get_site_job_profiler
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        directory = os.path.join(tmp, 'profiles')
+
+        def slow_job():
+            return sum(range(1000))
+
+        def other_job():
+            return 1
+
+        profiler = SiteJobProfiler(directory, pattern='slow_*', threshold=0,
+                                   max_files=2)
+        assert_that(profiler.shouldProfile('other_job'), is_(False))
+        component.provideUtility(profiler, ISiteJobProfiler)
+        try:
+            run_job_in_site(other_job)
+            assert_that(os.path.exists(directory), is_(False))
+            for _ in range(3):
+                run_job_in_site(slow_job)
+        finally:
+            component.getGlobalSiteManager().unregisterUtility(profiler, ISiteJobProfiler)
+
+        files = os.listdir(directory)
+        assert_that(files, has_length(2))
+        assert_that(files[0].startswith('slow_job-'), is_(True))
+        stats = pstats.Stats(os.path.join(directory, files[0]))
+        assert_that([f for (_, _, f) in stats.stats if f == 'slow_job'],
+                    is_(['slow_job']))
+
+        # Sampling, with a threshold that isn't met.
+        profiler = SiteJobProfiler(directory, sample_rate=1.0, threshold=60)
+        assert_that(profiler.shouldProfile('other_job'), is_(True))
+        profiler.sample_rate = 0.0
+        assert_that(profiler.shouldProfile('other_job'), is_(False))
+
+        # From the environment.
+        assert_that(_get_site_job_profiler(), is_(none()))
+        os.environ['NTI_SITE_JOB_PROFILE_DIR'] = directory
+        os.environ['NTI_SITE_JOB_PROFILE_RATE'] = '0.5'
+        try:
+            profiler = _get_site_job_profiler()
+            assert_that(profiler.sample_rate, is_(0.5))
+            assert_that(profiler.threshold, is_(1.0))
+            assert_that(_get_site_job_profiler(), is_(profiler))
+        finally:
+            del os.environ['NTI_SITE_JOB_PROFILE_DIR']
+            del os.environ['NTI_SITE_JOB_PROFILE_RATE']
+        assert_that(_get_site_job_profiler(), is_(none()))
+
+    def test_conflict_hot_spots(self):
+        from persistent.mapping import PersistentMapping
+        from ZODB.POSException import ConflictError
+        from ..runner import ConflictHotSpots
+        from ..runner import conflict_hot_spots
+
+        obj = PersistentMapping()
+        obj._p_oid = b'\0' * 7 + b'\1'
+        conflict_hot_spots.clear()
+        self.addCleanup(conflict_hot_spots.clear)
+
+        attempts = []
+        def conflicting():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConflictError(object=obj)
+        run_job_in_site(conflicting, retries=2, sleep=0.001)
+        def other():
+            raise ConflictError()
+        # Conflicts count whether or not they're retried.
+        with self.assertRaises(ConflictError):
+            run_job_in_site(other, job_name='other', retries=1, sleep=0.001)
+        with self.assertRaises(ConflictError):
+            run_job_in_site(other, job_name='never retried')
+
+        top = conflict_hot_spots.getTopOffenders()
+        assert_that(sorted(x[:5] for x in top),
+                    is_([('conflicting', obj._p_oid,
+                          'persistent.mapping.PersistentMapping', None, 2),
+                         ('never retried', None, None, None, 1),
+                         ('other', None, None, None, 2)]))
+        assert_that(top[-1].job_name, is_('never retried'))
+        table = conflict_hot_spots.formatTopOffenders()
+        assert_that(table.splitlines(), has_length(4))
+        assert_that('0x01' in table, is_(True))
+
+        spots = ConflictHotSpots(max_entries=2)
+        for oid in b'a', b'b', b'a', b'c':
+            spots.record('job', ConflictError(oid=oid), u'site')
+        assert_that(len(spots), is_(2))
+        assert_that([(x.oid, x.count) for x in spots.getTopOffenders()],
+                    is_([(b'a', 2), (b'c', 1)]))
+
+    def test_deadline(self):
+        import time
+        from ZODB.POSException import ConflictError
+        from ..interfaces import DeadlineExceededError
+
+        assert_that(get_remaining_time(), is_(none()))
+        check_deadline()
+
+        remaining = []
+        def conflict():
+            remaining.append(get_remaining_time())
+            time.sleep(0.01)
+            raise ConflictError()
+
+        start = time.time()
+        with self.assertRaises(ConflictError):
+            # A long sleep between attempts is cut short.
+            run_job_in_site(conflict, retries=1000, sleep=10, deadline=start + 0.1)
+        assert_that(time.time() - start < 1, is_(True))
+        assert_that(len(remaining) < 20, is_(True))
+        assert_that(remaining[0] <= 0.1, is_(True))
+        assert_that(get_remaining_time(), is_(none()))
+
+        remaining = run_job_in_site(get_remaining_time, deadline=time.time() + 10)
+        assert_that(0 < remaining <= 10, is_(True))
+
+        def cooperative():
+            time.sleep(0.02)
+            check_deadline()
+        with self.assertRaises(DeadlineExceededError):
+            run_job_in_site(cooperative, retries=5, deadline=time.time() + 0.01)
+
+        # Once the deadline has passed, the function isn't run at all.
+        ran = []
+        with self.assertRaises(DeadlineExceededError):
+            run_job_in_site(lambda: ran.append(1), deadline=time.time())
+        assert_that(ran, is_([]))
+        assert_that(get_remaining_time(), is_(none()))
+
+    def test_join(self):
+        import time
+        from ..interfaces import DeadlineExceededError
+        from zope.site.folder import Folder
+        from zope.component.hooks import getSite
+        db = component.getUtility(IDatabase)
+        conn = db.open()
+        site = conn.root()[u'nti.dataserver'] = Folder()
+        site.setSiteManager(component.getGlobalSiteManager())
+        transaction.commit()
+        conn.close()
+
+        def inner():
+            getSite()['inner'] = Folder()
+            return getSite()._p_jar, get_remaining_time()
+
+        def failing():
+            getSite()['failed'] = Folder()
+            raise ValueError()
+
+        def outer():
+            getSite()['outer'] = Folder()
+            jar, remaining = run_job_in_site(inner, join=True,
+                                             deadline=time.time() + 100)
+            # Same connection, and the earlier deadline applies
+            assert_that(jar, is_(getSite()._p_jar))
+            assert_that(remaining <= 10, is_(True))
+            with self.assertRaises(ValueError):
+                run_job_in_site(failing, join=True)
+            with self.assertRaises(DeadlineExceededError):
+                run_job_in_site(failing, join=True, deadline=time.time() - 1)
+            return sorted(getSite())
+
+        result = run_job_in_site(outer, deadline=time.time() + 10)
+        assert_that(result, is_(['inner', 'outer']))
+
+        conn = db.open()
+        assert_that(sorted(conn.root()[u'nti.dataserver']), is_(['inner', 'outer']))
+        conn.close()
+
+        # Outside a job, join does nothing special
+        assert_that(run_job_in_site(lambda: getSite()._p_jar, join=True),
+                    is_(not_none()))
+
+
+class TestSiteExecutor(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        super(TestSiteExecutor, self).setUp()
+        for site in _SITES:
+            site.__init__(site.__parent__, name=site.__name__, bases=site.__bases__)
+            BASE.registerUtility(site, name=site.__name__, provided=IComponents)
+
+    def tearDown(self):
+        for site in _SITES:
+            BASE.unregisterUtility(site, name=site.__name__, provided=IComponents)
+        super(TestSiteExecutor, self).tearDown()
+
+    @WithMockDS
+    def test_site_executor(self):
+        from zope.component.hooks import getSite
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        def site_and_jar(suffix=''):
+            return getSite().__name__ + suffix, id(getSite()._p_jar)
+
+        executor = SiteExecutor(max_workers=1)
+        with registered_database(self.db):
+            try:
+                with mock_db_trans(self.db, site_name=DEMO.__name__):
+                    future = executor.submit(site_and_jar, suffix='!')
+                    name, jar = future.result()
+                assert_that(name, is_(DEMO.__name__ + '!'))
+
+                with mock_db_trans(self.db, site_name=EVAL.__name__):
+                    results = list(executor.map(site_and_jar, ['1', '2']))
+                assert_that(results, is_([(EVAL.__name__ + '1', jar),
+                                          (EVAL.__name__ + '2', jar)]))
+            finally:
+                executor.shutdown()
+        assert_that([t.is_alive() for t in executor._threads], is_([False]))
+
+    @WithMockDS
+    def test_site_executor_affinity(self):
+        import threading
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        def thread_name():
+            return threading.current_thread().name
+
+        executor = SiteExecutor(max_workers=4)
+        with registered_database(self.db):
+            try:
+                threads = {}
+                for _ in range(3):
+                    for site in DEMO, EVAL, EVALALPHA:
+                        with mock_db_trans(self.db, site_name=site.__name__):
+                            name = executor.submit(thread_name).result()
+                        threads.setdefault(site.__name__, set()).add(name)
+                for site_name, names in threads.items():
+                    assert_that(names,
+                                is_({'SiteExecutor-%d' % get_host_site_shard(site_name, 4)}))
+                assert_that(executor.steals, is_(0))
+
+                # If the worker for a site is busy, another one runs its jobs.
+                started = threading.Event()
+                release = threading.Event()
+                def block():
+                    started.set()
+                    release.wait(5)
+                    return thread_name()
+                with mock_db_trans(self.db, site_name=DEMO.__name__):
+                    blocked = executor.submit(block)
+                    started.wait(5)
+                    stolen = executor.submit(thread_name).result(5)
+                release.set()
+                assert_that(blocked.result(), is_(threads[DEMO.__name__].pop()))
+                assert_that(stolen, is_not(blocked.result()))
+                assert_that(executor.steals, is_(1))
+            finally:
+                executor.shutdown()
@@ -13,9 +13,12 @@ from hamcrest import is_not
 from hamcrest import raises
 from hamcrest import calling
 from hamcrest import has_key
+from hamcrest import has_item
 from hamcrest import contains
+from hamcrest import none
 from hamcrest import not_none
 from hamcrest import has_length
+from hamcrest import less_than
 from hamcrest import assert_that
 from hamcrest import has_property
 from hamcrest import same_instance
@@ -43,9 +46,11 @@ from nti.site.site import SiteMapping
 
 from nti.site.subscribers import threadSiteSubscriber
 
+from nti.site.transient import TrivialSite
 from nti.site.transient import HostSiteManager as HSM
 
 from nti.site.tests import SharedConfiguringTestLayer
+from nti.site.tests import registered_database
 
 from nti.testing.matchers import validly_provides
 
@@ -172,15 +177,34 @@ DEMOALPHA = BaseComponents(DEMO,
 _SITES = (EVAL, EVALALPHA, DEMO, DEMOALPHA)
 
 from zope.component.interfaces import ISite
+from zope.interface.interfaces import ComponentLookupError
+from zope.traversing.interfaces import IEtcNamespace
 from zope.interface.interfaces import IComponents
 
 from zope.site.interfaces import INewLocalSite
 
 from nti.site.interfaces import IHostPolicySiteManager
 
+from nti.site.folder import HostSitesFolder
+
 from nti.site.hostpolicy import synchronize_host_policies
 from nti.site.hostpolicy import run_job_in_all_host_sites
 from nti.site.hostpolicy import get_host_site
+from nti.site.hostpolicy import get_all_host_sites
+from nti.site.hostpolicy import iter_all_host_sites
+from nti.site.hostpolicy import get_host_subtree_sites
+from nti.site.hostpolicy import run_job_in_host_subtree
+from nti.site.hostpolicy import get_all_host_site_levels
+from nti.site.hostpolicy import get_host_site_shard
+from nti.site.hostpolicy import get_host_sites_folder
+from nti.site.hostpolicy import HostSiteSpec
+from nti.site.hostpolicy import HostSiteUtilitySpec
+from nti.site.hostpolicy import install_host_sites
+from nti.site.hostpolicy import read_host_site_manifest
+
+from nti.site.runner import provision_host_sites
+from nti.site.runner import run_job_in_all_host_sites_parallel
+from nti.site.runner import run_job_in_all_host_sites_sequential
 
 from nti.site.site import _find_site_components
 from nti.site.site import get_site_for_site_names
@@ -201,6 +225,13 @@ class ASync(object):
 class OtherSync(object):
     pass
 
+from persistent import Persistent
+from zope.container.contained import Contained
+
+@interface.implementer(ITestSiteSync)
+class PersistentSync(Persistent, Contained):
+    pass
+
 class TestSiteSync(unittest.TestCase):
 
     layer = SharedConfiguringTestLayer
@@ -351,6 +382,638 @@ class TestSiteSync(unittest.TestCase):
         # No new sites created
         assert_that(self._events, has_length(len(_SITES)))
 
+    @WithMockDS
+    def test_host_site_order_cached(self):
+        expected = [EVAL.__name__, DEMO.__name__,
+                    EVALALPHA.__name__, DEMOALPHA.__name__]
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites.orderedSiteNames, is_(none()))
+            # Synchronizing stores the order.
+            synchronize_host_policies()
+            assert_that(list(sites.orderedSiteNames), is_(expected))
+            assert_that([x.__name__ for x in get_all_host_sites()],
+                        is_(expected))
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            cached = sites.orderedSiteNames
+            assert_that(list(cached), is_(expected))
+            assert_that(get_all_host_sites()[0], is_(same_instance(sites[EVAL.__name__])))
+            assert_that(sites.orderedSiteNames, is_(same_instance(cached)))
+
+            # Re-basing invalidates
+            demo_alpha = sites[DEMOALPHA.__name__].getSiteManager()
+            demo_alpha.__bases__ = (DEMOALPHA, sites[EVALALPHA.__name__].getSiteManager())
+            assert_that(sites.orderedSiteNames, is_(none()))
+            assert_that([x.__name__ for x in get_all_host_sites()],
+                        is_(expected))
+
+            # As does removal...
+            del sites[DEMOALPHA.__name__]
+            assert_that(sites.orderedSiteNames, is_(none()))
+            assert_that([x.__name__ for x in get_all_host_sites()],
+                        is_(expected[:-1]))
+            # ...which readers don't store.
+            assert_that(sites.orderedSiteNames, is_(none()))
+
+            # Addition stores it again.
+            synchronize_host_policies()
+            assert_that(list(sites.orderedSiteNames), is_(expected))
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            sites.invalidateSiteOrder()
+
+        # Reading never changes the folder.
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites.orderedSiteNames, is_(none()))
+            assert_that([x.__name__ for x in get_all_host_sites()],
+                        is_(expected))
+            assert_that([x.__name__ for x in get_all_host_sites()],
+                        is_(expected))
+            assert_that(sites._p_changed, is_(False))
+            assert_that(sites.orderedSiteNames, is_(none()))
+
+    @WithMockDS
+    def test_iter_all_host_sites_deactivates(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            expected = [x.__name__ for x in get_all_host_sites()]
+            for site in sites.values():
+                site.getSiteManager()._p_activate()
+
+            seen = []
+            def callback(site, result):
+                assert_that(site.getSiteManager(), is_(same_instance(result)))
+                # The previous site has been finished
+                if seen:
+                    previous = sites[seen[-1]]
+                    assert_that(previous._p_status, is_('ghost'))
+                seen.append(site.__name__)
+
+            result = run_job_in_all_host_sites(component.getSiteManager, callback)
+            assert_that(result, is_(none()))
+            assert_that(seen, is_(expected))
+            for site in sites.values():
+                assert_that(site._p_status, is_('ghost'))
+
+            # Without deactivating
+            for site in iter_all_host_sites(deactivate=False):
+                site.getSiteManager()._p_activate()
+            for site in sites.values():
+                assert_that(site.getSiteManager()._p_status, is_('saved'))
+
+    @WithMockDS
+    def test_host_subtree(self):
+        with mock_db_trans() as conn:
+            synchronize_host_policies()
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((DEMO.__name__, EVALALPHA.__name__)))
+            assert_that(sites.getParentSiteName(DEMOALPHA.__name__),
+                        is_(DEMO.__name__))
+            assert_that(sites.getParentSiteName(EVAL.__name__), is_(none()))
+
+            # Synchronizing again changes nothing
+            assert_that(sites.indexSite(DEMO.__name__, EVAL.__name__), is_(False))
+
+            assert_that([x.__name__ for x in get_host_subtree_sites(EVAL.__name__)],
+                        is_([x.__name__ for x in get_all_host_sites()]))
+            assert_that([x.__name__ for x in get_host_subtree_sites(sites[DEMO.__name__])],
+                        is_([DEMO.__name__, DEMOALPHA.__name__]))
+
+            names = run_job_in_host_subtree(DEMO.__name__,
+                                            lambda: getSite().__name__)
+            assert_that(names, is_([DEMO.__name__, DEMOALPHA.__name__]))
+
+        with mock_db_trans() as conn:
+            # Without an index (a database from before it existed), the
+            # subtree is found from the bases.
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            index = sites._siteParents, sites._siteChildren
+            sites._siteParents = sites._siteChildren = None
+            assert_that(sites.hasSiteIndex(), is_(False))
+            assert_that([x.__name__ for x in get_host_subtree_sites(DEMO.__name__)],
+                        is_([DEMO.__name__, DEMOALPHA.__name__]))
+            assert_that([x.__name__ for x in get_host_subtree_sites(EVAL.__name__)],
+                        is_([EVAL.__name__, DEMO.__name__, EVALALPHA.__name__,
+                             DEMOALPHA.__name__]))
+            sites._siteParents, sites._siteChildren = index
+
+        # A flat hierarchy is indexed too.
+        flat = HostSitesFolder()
+        assert_that(flat.hasSiteIndex(), is_(False))
+        assert_that(flat.indexSite('a.example.com'), is_(True))
+        assert_that(flat.hasSiteIndex(), is_(True))
+        assert_that(flat.indexSite('b.example.com'), is_(False))
+        assert_that(flat.getChildSiteNames('a.example.com'), is_(()))
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            del sites[DEMO.__name__]
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((EVALALPHA.__name__,)))
+            assert_that(sites.getChildSiteNames(DEMO.__name__), is_(()))
+            assert_that(sites.getParentSiteName(DEMOALPHA.__name__), is_(none()))
+
+            # Putting it back restores the index
+            synchronize_host_policies()
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        is_((DEMO.__name__, EVALALPHA.__name__)))
+            assert_that(sites.getParentSiteName(DEMOALPHA.__name__),
+                        is_(DEMO.__name__))
+
+    @WithMockDS
+    def test_run_job_in_all_host_sites_parallel(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+            assert_that(get_all_host_site_levels(),
+                        is_([[EVAL.__name__],
+                             [DEMO.__name__, EVALALPHA.__name__],
+                             [DEMOALPHA.__name__]]))
+
+        finished = []
+        def func():
+            name = getSite().__name__
+            parent = getSite().__parent__.getParentSiteName(name)
+            # Parents are done first
+            assert parent is None or parent in finished
+            finished.append(name)
+            if name == DEMO.__name__:
+                raise ValueError(name)
+            getSite()['marker'] = ASync()
+            return name
+        with registered_database(self.db):
+            results = run_job_in_all_host_sites_parallel(func, max_workers=2)
+
+        assert_that([x.site_name for x in results],
+                    is_([EVAL.__name__, DEMO.__name__,
+                         EVALALPHA.__name__, DEMOALPHA.__name__]))
+        for result in results:
+            if result.site_name == DEMO.__name__:
+                assert_that(result.exception, is_(ValueError))
+                assert_that(result.result, is_(none()))
+            else:
+                assert_that(result.exception, is_(none()))
+                assert_that(result.result, is_(result.site_name))
+
+        # Each site committed its own transaction
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites[EVAL.__name__], has_key('marker'))
+            assert_that(sites[DEMOALPHA.__name__], has_key('marker'))
+            assert_that(sites[DEMO.__name__], does_not(has_key('marker')))
+
+    @WithMockDS
+    def test_run_job_in_all_host_sites_snapshot(self):
+        from ZODB.utils import p64
+        from ZODB.utils import u64
+        from transaction import TransactionManager
+        with mock_db_trans():
+            synchronize_host_policies()
+        before = p64(u64(self.db.lastTransaction()) + 1)
+        with mock_db_trans() as conn:
+            conn.root()['nti.dataserver']['++etc++hostsites'][DEMOALPHA.__name__]['marker'] = ASync()
+
+        def has_marker():
+            return 'marker' in getSite()
+
+        def add_marker_elsewhere():
+            # Commit a change to a site we haven't visited yet.
+            if getSite().__name__ == EVAL.__name__:
+                txm = TransactionManager()
+                conn = self.db.open(txm)
+                conn.root()['nti.dataserver']['++etc++hostsites'][DEMO.__name__]['marker'] = ASync()
+                txm.commit()
+                conn.close()
+            return 'marker' in getSite()
+
+        with registered_database(self.db):
+            results = run_job_in_all_host_sites_sequential(has_marker, snapshot=before)
+            assert_that([x.result for x in results], is_([False] * 4))
+            results = run_job_in_all_host_sites_parallel(has_marker, snapshot=before)
+            assert_that([x.result for x in results], is_([False] * 4))
+
+            results = run_job_in_all_host_sites_sequential(has_marker)
+            assert_that([x.result for x in results], is_([False, False, False, True]))
+
+            results = run_job_in_all_host_sites_sequential(add_marker_elsewhere, snapshot=True)
+            assert_that([x.result for x in results], is_([False, False, False, True]))
+            results = run_job_in_all_host_sites_sequential(has_marker)
+            assert_that([x.result for x in results], is_([False, True, False, True]))
+
+            assert_that(calling(run_job_in_all_host_sites_sequential).with_args(
+                has_marker, checkpoint='check', snapshot=True),
+                        raises(ValueError))
+            assert_that(calling(run_job_in_all_host_sites_sequential).with_args(
+                has_marker, checkpoint='check', side_effect_free=True),
+                        raises(ValueError))
+
+    @WithMockDS
+    def test_run_job_in_all_host_sites_sequential_checkpoint(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        ran = []
+        def func():
+            name = getSite().__name__
+            ran.append(name)
+            getSite()['marker'] = ASync()
+            if name == DEMO.__name__ and len(ran) < 5:
+                raise ValueError(name)
+            return name
+        with registered_database(self.db):
+            results = run_job_in_all_host_sites_sequential(func, checkpoint='migrate')
+            assert_that(ran, is_([EVAL.__name__, DEMO.__name__,
+                                  EVALALPHA.__name__, DEMOALPHA.__name__]))
+            assert_that([x.exception for x in results],
+                        contains(none(), is_(ValueError), none(), none()))
+
+            # Restarting only runs what failed
+            results = run_job_in_all_host_sites_sequential(func, checkpoint='migrate')
+            assert_that(results, is_([(DEMO.__name__, DEMO.__name__, None)]))
+
+            # Nothing left to do
+            results = run_job_in_all_host_sites_sequential(func, checkpoint='migrate')
+            assert_that(results, is_([]))
+            # Without a checkpoint, everything runs.
+            results = run_job_in_all_host_sites_sequential(func)
+            assert_that(results, has_length(4))
+            # Unless we shard
+            results = run_job_in_all_host_sites_sequential(
+                func,
+                shard_index=get_host_site_shard(DEMO.__name__, 2),
+                shard_count=2)
+            assert_that([x.site_name for x in results],
+                        is_([x.__name__ for x in (EVAL, DEMO, EVALALPHA, DEMOALPHA)
+                             if (get_host_site_shard(x.__name__, 2)
+                                 == get_host_site_shard(DEMO.__name__, 2))]))
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sorted(sites.getJobCheckpoint('migrate')),
+                        is_(sorted(x.__name__ for x in _SITES)))
+            assert_that(sites[DEMO.__name__].hasJobCheckpoint('migrate'), is_(True))
+            assert_that(sites.getJobCheckpoint('other'), is_([]))
+            sites.removeJobCheckpoint('migrate')
+            assert_that(sites.getJobCheckpoint('migrate'), is_([]))
+            assert_that(sites[DEMO.__name__].hasJobCheckpoint('migrate'), is_(False))
+
+    @WithMockDS
+    def test_sharded_iteration(self):
+        assert_that(get_host_site_shard(DEMO.__name__, 3),
+                    is_(get_host_site_shard(DEMO.__name__.encode('utf-8'), 3)))
+        with mock_db_trans():
+            synchronize_host_policies()
+            all_names = [x.__name__ for x in get_all_host_sites()]
+
+            seen = []
+            for shard_index in range(3):
+                names = [x.__name__ for x in iter_all_host_sites(shard_index=shard_index,
+                                                                 shard_count=3)]
+                assert_that(names, is_([x for x in all_names
+                                        if get_host_site_shard(x, 3) == shard_index]))
+                seen.extend(names)
+                results = run_job_in_all_host_sites(lambda: getSite().__name__,
+                                                    shard_index=shard_index,
+                                                    shard_count=3)
+                assert_that(results, is_(names))
+            assert_that(sorted(seen), is_(sorted(all_names)))
+
+            is_alpha = lambda site: 'alpha' in site.__name__
+            assert_that([x.__name__ for x in iter_all_host_sites(predicate=is_alpha)],
+                        is_([EVALALPHA.__name__, DEMOALPHA.__name__]))
+            assert_that(get_all_host_site_levels(predicate=is_alpha),
+                        is_([[], [EVALALPHA.__name__], [DEMOALPHA.__name__]]))
+
+            assert_that(calling(list).with_args(iter_all_host_sites(shard_index=1)),
+                        raises(ValueError))
+            assert_that(calling(list).with_args(iter_all_host_sites(shard_index=2,
+                                                                    shard_count=2)),
+                        raises(ValueError))
+
+    @WithMockDS
+    def test_sharded_levels_dont_load_other_sites(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            expected = get_all_host_site_levels()
+            # The order has to be computed.
+            sites.invalidateSiteOrder()
+            conn.cacheMinimize()
+            conn.getTransferCounts(True)
+            assert_that(get_all_host_site_levels(), is_(expected))
+            # Only the folder and its index, not the sites.
+            loads, _ = conn.getTransferCounts(True)
+            assert_that(loads, is_(less_than(len(sites))))
+            for site in sites.values():
+                assert_that(site._p_changed, is_(none()))
+
+            # Only the sites in the shard are given to the predicate.
+            seen = []
+            def predicate(site):
+                seen.append(site.__name__)
+                return True
+            get_all_host_site_levels(shard_index=0, shard_count=2, predicate=predicate)
+            assert_that(seen, is_([name for level in expected for name in level
+                                   if get_host_site_shard(name, 2) == 0]))
+
+    @WithMockDS
+    def test_iter_all_host_sites_prefetch(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            names = [x.__name__ for x in get_all_host_sites()]
+            assert_that(names, has_length(4))
+            conn.cacheMinimize()
+            folders = [sites[x] for x in names]
+
+            prefetched = []
+            conn.prefetch = lambda oids: prefetched.append(list(oids))
+
+            visited = []
+            for site in iter_all_host_sites(prefetch=3):
+                visited.append(site.__name__)
+                if len(visited) == 1:
+                    # The following folders, which are still ghosts.
+                    assert_that(prefetched, is_([[x._p_oid for x in folders[1:]]]))
+                    for folder in folders[1:]:
+                        assert_that(folder._p_changed, is_(none()))
+                elif len(visited) == 2:
+                    # Those folders have been activated, and their site
+                    # managers are next.
+                    assert_that(folders[2]._p_changed, is_(False))
+                    assert_that(folders[3]._p_changed, is_(False))
+                    assert_that(prefetched[-1],
+                                is_([x.getSiteManager()._p_oid for x in folders[2:]]))
+                    assert_that(folders[3].getSiteManager()._p_changed, is_(none()))
+                elif len(visited) == 3:
+                    # Then the registries.
+                    site_manager = folders[3].getSiteManager()
+                    assert_that(site_manager._p_changed, is_(False))
+                    assert_that(prefetched[-1],
+                                is_([site_manager.adapters._p_oid,
+                                     site_manager.utilities._p_oid]))
+            assert_that(prefetched, has_length(3))
+            assert_that(visited, is_(names))
+            # Nothing is asked for twice
+            all_prefetched = [oid for oids in prefetched for oid in oids]
+            assert_that(sorted(set(all_prefetched)), is_(sorted(all_prefetched)))
+
+            # Storages that don't support it are fine.
+            del conn.prefetch
+            conn.cacheMinimize()
+            result = run_job_in_all_host_sites(lambda: getSite().__name__, prefetch=3)
+            assert_that(result, is_(names))
+
+    @WithMockDS
+    def test_host_site_caches(self):
+        with mock_db_trans() as conn:
+            synchronize_host_policies()
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(get_host_sites_folder(), is_(same_instance(sites)))
+
+            # The folder is cached for the transaction...
+            lsm = component.getSiteManager()
+            lsm.unregisterUtility(sites, provided=IEtcNamespace, name='hostsites')
+            assert_that(get_host_sites_folder(), is_(same_instance(sites)))
+            # ...and site manager.
+            with currentSite(sites[EVAL.__name__]):
+                assert_that(calling(get_host_sites_folder),
+                            raises(ComponentLookupError))
+            lsm.registerUtility(sites, provided=IEtcNamespace, name='hostsites')
+
+            demo = get_host_site(DEMO.__name__)
+            assert_that(demo, is_(same_instance(sites[DEMO.__name__])))
+            assert_that(sites._getTransactionCache(), has_key(('site', DEMO.__name__)))
+            assert_that(get_host_site(DEMO.__name__), is_(same_instance(demo)))
+
+            get_host_site(DEMOALPHA.__name__)
+            del sites[DEMOALPHA.__name__]
+            assert_that(sites._getTransactionCache(), is_({}))
+            assert_that(calling(get_host_site).with_args(DEMOALPHA.__name__),
+                        raises(KeyError))
+
+    @WithMockDS
+    def test_host_site_cache_sees_other_connections(self):
+        from transaction import TransactionManager
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        txm1 = TransactionManager(explicit=True)
+        conn1 = self.db.open(txm1)
+        txm1.begin()
+        sites = conn1.root()['nti.dataserver']['++etc++hostsites']
+        assert_that(sites.getHostSite(DEMOALPHA.__name__), is_(not_none()))
+
+        # Another connection removes the site.
+        txm2 = TransactionManager()
+        conn2 = self.db.open(txm2)
+        del conn2.root()['nti.dataserver']['++etc++hostsites'][DEMOALPHA.__name__]
+        txm2.commit()
+        conn2.close()
+
+        # Not visible in this transaction...
+        assert_that(sites.getHostSite(DEMOALPHA.__name__), is_(not_none()))
+        txm1.abort()
+
+        # ...but in the next one, even though the folder wasn't changed.
+        txm1.begin()
+        try:
+            assert_that(DEMOALPHA.__name__ in sites, is_(False))
+            assert_that(calling(sites.getHostSite).with_args(DEMOALPHA.__name__),
+                        raises(KeyError))
+        finally:
+            txm1.abort()
+            conn1.close()
+
+    @WithMockDS
+    def test_provision_host_sites(self):
+        import io
+        import json
+        from zope.lifecycleevent.interfaces import IObjectAddedEvent
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        manifest = json.dumps({'sites': [
+            # Children may come before parents
+            {'name': 'child.prov.example.com', 'parent': 'prov.example.com',
+             'utilities': [{'name': 'sync',
+                            'factory': __name__ + '.PersistentSync',
+                            'provided': __name__ + '.ITestSiteSync'}]},
+            {'name': 'prov.example.com', 'parent': EVAL.__name__},
+            {'name': 'other.example.com'},
+            # Existing sites are left alone
+            {'name': DEMO.__name__},
+        ]})
+        specs = read_host_site_manifest(io.StringIO(manifest), 'json')
+        assert_that([x.name for x in specs],
+                    is_(['child.prov.example.com', 'prov.example.com',
+                         'other.example.com', DEMO.__name__]))
+
+        csv_specs = read_host_site_manifest(io.StringIO(
+            'name,parent,utility_name,utility_factory,utility_provided\n'
+            'prov.example.com,%s,,,\n'
+            'child.prov.example.com,prov.example.com,sync,%s.PersistentSync,%s.ITestSiteSync\n'
+            'other.example.com,,,,\n'
+            '%s,,,,\n' % (EVAL.__name__, __name__, __name__, DEMO.__name__)),
+                                             'csv')
+        assert_that(sorted(csv_specs), is_(sorted(specs)))
+
+        # Paths are opened in the right mode for the csv module.
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(u'name,parent\nb\u00fccher.example.com,%s\n'.encode('utf-8')
+                        % (EVAL.__name__.encode('utf-8'),))
+            assert_that(read_host_site_manifest(path),
+                        is_([HostSiteSpec(u'b\u00fccher.example.com', EVAL.__name__, ())]))
+        finally:
+            os.remove(path)
+
+        added = []
+        def on_added(site, event):
+            # All the sites in the chunk already exist.
+            added.append(sorted(event.newParent))
+        BASE.registerHandler(on_added, (IHostPolicyFolder, IObjectAddedEvent))
+        try:
+            with registered_database(self.db):
+                names = provision_host_sites(specs, chunk_size=2)
+        finally:
+            BASE.unregisterHandler(on_added, (IHostPolicyFolder, IObjectAddedEvent))
+
+        assert_that(names, is_(['prov.example.com', 'child.prov.example.com',
+                                'other.example.com']))
+        assert_that(added, has_length(3))
+        assert_that(added[0], is_(added[1]))
+        assert_that(added[0], has_item('child.prov.example.com'))
+        assert_that(added[2], has_item('other.example.com'))
+
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites.getParentSiteName('child.prov.example.com'),
+                        is_('prov.example.com'))
+            assert_that(sites.getChildSiteNames(EVAL.__name__),
+                        has_item('prov.example.com'))
+            child = sites['child.prov.example.com'].getSiteManager()
+            parent = sites['prov.example.com'].getSiteManager()
+            assert_that(child.__bases__, is_((parent,)))
+            assert_that(parent.__bases__,
+                        is_((sites[EVAL.__name__].getSiteManager(),)))
+            assert_that(sites['other.example.com'].getSiteManager().__bases__,
+                        is_((sites.__parent__.getSiteManager(),)))
+            utility = child.getUtility(ITestSiteSync)
+            assert_that(utility, is_(PersistentSync))
+            assert_that(utility, same_instance(child['sync']))
+            assert_that(utility.__parent__, same_instance(child))
+
+        # Running again does nothing
+        with registered_database(self.db):
+            assert_that(provision_host_sites(specs), is_([]))
+
+        # Names are checked as for any container.
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(calling(install_host_sites).with_args(
+                [HostSiteSpec(u'', None, ())]),
+                        raises(ValueError))
+            assert_that(u'' in sites, is_(False))
+            # The site manager already has a folder called 'default'.
+            assert_that(calling(install_host_sites).with_args(
+                [HostSiteSpec(u'bad.example.com', None,
+                              (HostSiteUtilitySpec(u'default',
+                                                   __name__ + '.PersistentSync',
+                                                   __name__ + '.ITestSiteSync'),))]),
+                        raises(KeyError))
+            site_manager = sites[u'bad.example.com'].getSiteManager()
+            assert_that(site_manager['default'], is_not(PersistentSync))
+            assert_that(site_manager, has_length(1))
+            conn.transaction_manager.get().doom()
+
+    @WithMockDS
+    def test_lazy_host_sites(self):
+        with mock_db_trans() as conn:
+            synchronize_host_policies(lazy=True)
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sites.lazySiteCreation, is_(True))
+            assert_that(list(sites), is_([]))
+
+        # A transaction that can't commit gets a transient site
+        with mock_db_trans() as conn:
+            conn.transaction_manager.get().doom()
+            site = get_site_for_site_names((DEMOALPHA.__name__,))
+            assert_that(site, is_(TrivialSite))
+            assert_that(site.__name__, is_(DEMOALPHA.__name__))
+            ds_sm = conn.root()['nti.dataserver'].getSiteManager()
+            assert_that(site.getSiteManager().__bases__, is_((DEMOALPHA, ds_sm)))
+            assert_that(component.getUtility(ITestSiteSync, context=site),
+                        is_(ASync))
+            assert_that(list(conn.root()['nti.dataserver']['++etc++hostsites']),
+                        is_([]))
+
+        # Otherwise, the site and its ancestors are created
+        with mock_db_trans() as conn:
+            site = get_site_for_site_names((DEMO.__name__,))
+            assert_that(site, validly_provides(IHostPolicyFolder))
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sorted(sites), is_(sorted([EVAL.__name__, DEMO.__name__])))
+            assert_that(sites.getParentSiteName(DEMO.__name__), is_(EVAL.__name__))
+            assert_that(site.getSiteManager().__bases__,
+                        is_((DEMO, sites[EVAL.__name__].getSiteManager())))
+
+        # Later first uses don't change the folder, so they can't
+        # conflict with each other there.
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            site = get_site_for_site_names((EVALALPHA.__name__,))
+            assert_that(site, validly_provides(IHostPolicyFolder))
+            assert_that(sites._p_changed, is_(False))
+            assert_that(sites.getOrderedSiteNames(), is_(none()))
+            assert_that([x.__name__ for x in get_all_host_sites()],
+                        is_([EVAL.__name__, DEMO.__name__, EVALALPHA.__name__]))
+
+        # The transient site uses the nearest persistent ancestor
+        with mock_db_trans() as conn:
+            conn.transaction_manager.get().doom()
+            site = get_site_for_site_names((DEMOALPHA.__name__,))
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(site.getSiteManager().__bases__,
+                        is_((DEMOALPHA, sites[DEMO.__name__].getSiteManager())))
+
+        # Read-only and side-effect free jobs get a transient site too.
+        from nti.site.runner import run_job_in_site
+        def site_class():
+            return type(getSite())
+        with registered_database(self.db):
+            for kwargs in dict(read_only=True), dict(side_effect_free=True):
+                assert_that(run_job_in_site(site_class,
+                                            site_names=(DEMOALPHA.__name__,),
+                                            **kwargs),
+                            is_(same_instance(TrivialSite)))
+        with mock_db_trans() as conn:
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(DEMOALPHA.__name__ in sites, is_(False))
+
+        # Turning it off creates the rest
+        with mock_db_trans() as conn:
+            synchronize_host_policies(lazy=False)
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            assert_that(sorted(sites), is_(sorted(x.__name__ for x in _SITES)))
+            assert_that(get_site_for_site_names((DEMOALPHA.__name__,)),
+                        same_instance(sites[DEMOALPHA.__name__]))
+
     @WithMockDS
     def test_site_mapping(self):
         """
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import same_instance
+
+import functools
+import unittest
+
+from zope.component.hooks import getSite
+
+from zope.interface.interfaces import IComponents
+
+from ZODB.POSException import ConflictError
+
+from nti.site.interfaces import ISiteWorkQueue
+
+from nti.site.hostpolicy import synchronize_host_policies
+
+from nti.site.workqueue import SiteWorkQueue
+from nti.site.workqueue import _get_pending_jobs
+from nti.site.workqueue import SiteWorkQueueConsumer
+from nti.site.workqueue import get_site_work_queue
+from nti.site.workqueue import install_site_work_queue
+
+from nti.site.testing import uses_independent_db_site as WithMockDS
+from nti.site.testing import persistent_site_trans as mock_db_trans
+
+from nti.site.tests import SharedConfiguringTestLayer
+from nti.site.tests import registered_database
+from nti.site.tests.test_sync import BASE
+from nti.site.tests.test_sync import DEMO
+from nti.site.tests.test_sync import EVAL
+from nti.site.tests.test_sync import _SITES
+
+from nti.testing.matchers import validly_provides
+
+#: The (site name, argument) of each job run
+_ran = []
+
+def _job(arg):
+    _ran.append((getSite().__name__, arg))
+
+def _failing_job(arg):
+    getSite().failed = arg
+    raise ValueError(arg)
+
+def _conflicting_job(arg):
+    getSite().failed = arg
+    raise ConflictError()
+
+#: How many more times _briefly_conflicting_job conflicts
+_conflicts = []
+
+def _briefly_conflicting_job(arg):
+    if _conflicts:
+        _conflicts.pop()
+        raise ConflictError()
+    _ran.append((getSite().__name__, arg))
+
+
+class TestSiteWorkQueue(unittest.TestCase):
+
+    def test_queue(self):
+        queue = SiteWorkQueue()
+        assert_that(queue, validly_provides(ISiteWorkQueue))
+        assert_that(bool(queue), is_(True))
+        for i in range(5):
+            queue.put(i)
+        assert_that(len(queue), is_(5))
+        assert_that(queue.pull(2), is_([0, 1]))
+        assert_that(queue.pull(10), is_([2, 3, 4]))
+        assert_that(queue.pull(), is_([]))
+        assert_that(len(queue), is_(0))
+
+        queue.put('a')
+        queue.put('b')
+        keys = queue.peekKeys(5)
+        assert_that(keys, has_length(2))
+        assert_that(len(queue), is_(2))
+        assert_that(queue.pullKey(keys[1]), is_('b'))
+        assert_that(queue.pullKey(keys[1]), is_(none()))
+        assert_that(len(queue), is_(1))
+        assert_that(queue.pull(), is_(['a']))
+
+
+class TestSiteWorkQueueConsumer(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        super(TestSiteWorkQueueConsumer, self).setUp()
+        for site in _SITES:
+            site.__init__(site.__parent__, name=site.__name__, bases=site.__bases__)
+            BASE.registerUtility(site, name=site.__name__, provided=IComponents)
+        del _ran[:]
+
+    def tearDown(self):
+        for site in _SITES:
+            BASE.unregisterUtility(site, name=site.__name__, provided=IComponents)
+        super(TestSiteWorkQueueConsumer, self).tearDown()
+
+    @WithMockDS
+    def test_consumer(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        with mock_db_trans(self.db, site_name=EVAL.__name__):
+            queue = install_site_work_queue()
+            assert_that(install_site_work_queue(), is_(same_instance(queue)))
+            for i in range(5):
+                queue.put(functools.partial(_job, i))
+
+        with mock_db_trans(self.db, site_name=DEMO.__name__):
+            # The parent's queue is not the child's.
+            assert_that(get_site_work_queue(), is_(none()))
+            queue = install_site_work_queue()
+            queue.put(functools.partial(_job, 'a'))
+            queue.put(functools.partial(_failing_job, 'b'))
+            queue.put(functools.partial(_job, 'c'))
+
+        with registered_database(self.db):
+            consumer = SiteWorkQueueConsumer(batch_size=2)
+            assert_that(consumer.process(max_rounds=1), is_(4))
+            # One batch from each site.
+            assert_that(sorted(_ran),
+                        is_(sorted([(EVAL.__name__, 0), (EVAL.__name__, 1),
+                                    (DEMO.__name__, 'a')])))
+
+            assert_that(consumer.process(), is_(4))
+            assert_that(consumer.process(), is_(0))
+
+        assert_that([arg for name, arg in _ran if name == EVAL.__name__],
+                    is_([0, 1, 2, 3, 4]))
+        assert_that([arg for name, arg in _ran if name == DEMO.__name__],
+                    is_(['a', 'c']))
+
+        with mock_db_trans(self.db, site_name=DEMO.__name__):
+            assert_that(len(get_site_work_queue()), is_(0))
+            # The failed job was rolled back.
+            assert_that(getattr(getSite(), 'failed', None), is_(none()))
+
+    @WithMockDS
+    def test_consumer_poison_job(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        with mock_db_trans(self.db, site_name=DEMO.__name__):
+            queue = install_site_work_queue()
+            queue.put(functools.partial(_job, 'a'))
+            queue.put(functools.partial(_conflicting_job, 'b'))
+            queue.put(functools.partial(_job, 'c'))
+
+        with registered_database(self.db):
+            consumer = SiteWorkQueueConsumer(batch_size=3, retries=0, max_failures=2)
+            # The batch is split until the job that can never commit
+            # runs alone. It's left in the queue...
+            assert_that(consumer.process(max_rounds=1), is_(2))
+            with mock_db_trans(self.db, site_name=DEMO.__name__):
+                assert_that(len(get_site_work_queue()), is_(1))
+            # ...until it has failed too often; then it's discarded.
+            assert_that(consumer.process(), is_(1))
+            assert_that(consumer.process(), is_(0))
+
+        # Jobs in the batches that were rolled back ran again.
+        assert_that(sorted(set(_ran)), is_([(DEMO.__name__, 'a'), (DEMO.__name__, 'c')]))
+        with mock_db_trans(self.db, site_name=DEMO.__name__):
+            assert_that(len(get_site_work_queue()), is_(0))
+            assert_that(getattr(getSite(), 'failed', None), is_(none()))
+
+    @WithMockDS
+    def test_consumer_isolates_sites(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        for site in DEMO, EVAL:
+            with mock_db_trans(self.db, site_name=site.__name__):
+                install_site_work_queue().put(functools.partial(_job, 1))
+
+        with mock_db_trans() as conn:
+            # Finding the queues with jobs doesn't load the sites.
+            sites = conn.root()['nti.dataserver']['++etc++hostsites']
+            conn.cacheMinimize()
+            pending = _get_pending_jobs(10)
+            assert_that(sorted(name for name, _ in pending),
+                        is_(sorted([DEMO.__name__, EVAL.__name__])))
+            assert_that(sites[DEMO.__name__]._p_changed, is_(none()))
+
+        class Consumer(SiteWorkQueueConsumer):
+            def process_site(self, site_name, keys=None):
+                if site_name == DEMO.__name__:
+                    raise ValueError(site_name)
+                return super(Consumer, self).process_site(site_name, keys)
+
+        with registered_database(self.db):
+            # The failing site is logged, the other is still run, and
+            # we stop when no more progress is made.
+            assert_that(Consumer().process(), is_(1))
+            assert_that(_ran, is_([(EVAL.__name__, 1)]))
+            assert_that(SiteWorkQueueConsumer().process_site(DEMO.__name__), is_(1))
+
+    @WithMockDS
+    def test_consumer_transient_failure(self):
+        with mock_db_trans():
+            synchronize_host_policies()
+
+        with mock_db_trans(self.db, site_name=DEMO.__name__):
+            install_site_work_queue().put(functools.partial(_briefly_conflicting_job, 'a'))
+
+        _conflicts[:] = [1, 1]
+        with registered_database(self.db):
+            # A job that conflicts when run alone isn't lost.
+            consumer = SiteWorkQueueConsumer(retries=0, max_failures=3)
+            assert_that(consumer.process(), is_(0))
+            assert_that(consumer.process(), is_(0))
+            assert_that(consumer.process(), is_(1))
+            # Retrying is the default.
+            with mock_db_trans(self.db, site_name=DEMO.__name__):
+                get_site_work_queue().put(functools.partial(_briefly_conflicting_job, 'b'))
+            _conflicts[:] = [1]
+            assert_that(SiteWorkQueueConsumer().process(), is_(1))
+
+        assert_that(_ran, is_([(DEMO.__name__, 'a'), (DEMO.__name__, 'b')]))
+        with mock_db_trans(self.db, site_name=DEMO.__name__):
+            queue = get_site_work_queue()
+            assert_that(len(queue), is_(0))
+            # The failure count was forgotten.
+            assert_that(list(queue._failures), is_([]))
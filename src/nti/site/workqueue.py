@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent queues of background jobs for host sites, and a consumer
+that runs them in their sites.
+
+A :class:`SiteWorkQueue` is installed as a local utility of a site
+(:func:`install_site_work_queue`). Jobs put in it are run, in that
+site, by a :class:`SiteWorkQueueConsumer`.
+
+.. versionadded:: 3.1.0
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import functools
+import itertools
+import random
+import time
+
+from BTrees import family64
+from BTrees.Length import Length
+
+from persistent import Persistent
+
+import transaction
+from transaction.interfaces import TransientError
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import getSite
+
+from zope.container.contained import Contained
+
+from zope.traversing.interfaces import IEtcNamespace
+
+from nti.site.interfaces import ISiteWorkQueue
+
+from nti.site.localutility import install_utility
+
+from nti.site.runner import run_job_in_site
+from nti.site.runner import run_jobs_in_site_batch
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The name of the work queue in the site manager of a site.
+WORK_QUEUE_NAME = u'site_work_queue'
+
+#: The name of the :class:`SiteWorkQueueDirectory` in the site manager
+#: of the main application folder.
+WORK_QUEUE_DIRECTORY_NAME = u'site_work_queues'
+
+
+@interface.implementer(ISiteWorkQueue)
+class SiteWorkQueue(Persistent, Contained):
+    """
+    A FIFO queue of jobs, stored in a BTree.
+
+    Each job is stored under a key made of the time it was put,
+    in microseconds, and some random bits. Jobs put concurrently in
+    different transactions get different keys (so the BTree can
+    resolve the conflict), and the count of jobs is a
+    :class:`BTrees.Length.Length`. Taking jobs from the front while
+    others are put at the end is also resolved, unless both change
+    the same bucket so much that it must be split or removed.
+
+    Jobs put in the same microsecond are not necessarily run in the
+    order they were put.
+    """
+
+    _RANDOM_BITS = 10
+
+    # Lazily created BTree mapping the keys of jobs that failed
+    # transiently to how many times they did.
+    _failures = None
+
+    def __init__(self):
+        self._jobs = family64.IO.BTree()
+        self._length = Length()
+
+    def _new_key(self):
+        return ((int(time.time() * 1000000) << self._RANDOM_BITS)
+                | random.getrandbits(self._RANDOM_BITS))
+
+    def put(self, job):
+        key = self._new_key()
+        while not self._jobs.insert(key, job):
+            key += 1
+        self._length.change(1)
+
+    def pull(self, count=1):
+        jobs = [self._jobs.pop(key) for key in self.peekKeys(count)]
+        if jobs:
+            self._length.change(-len(jobs))
+        return jobs
+
+    def peekKeys(self, count=1):
+        return list(itertools.islice(self._jobs.keys(), count))
+
+    def pullKey(self, key):
+        job = self._jobs.pop(key, None)
+        if job is not None:
+            self._length.change(-1)
+            if self._failures is not None:
+                self._failures.pop(key, None)
+        return job
+
+    def recordFailure(self, key):
+        if self._failures is None:
+            self._failures = family64.IO.BTree()
+        count = self._failures.get(key, 0) + 1
+        self._failures[key] = count
+        return count
+
+    def __len__(self):
+        return self._length()
+
+    def __bool__(self):
+        # Like other containers, the queue is always true, even when
+        # empty, so it can be tested for existence.
+        return True
+    __nonzero__ = __bool__
+
+
+class SiteWorkQueueDirectory(Persistent, Contained):
+    """
+    Maps the names of host sites to their work queues, so that finding
+    the queues that have jobs doesn't load every site.
+
+    :func:`install_site_work_queue` keeps this in the site manager of
+    the main application folder.
+    """
+
+    def __init__(self):
+        self._queues = family64.OO.BTree()
+
+    def add(self, site_name, queue):
+        self._queues[site_name] = queue
+
+    def items(self):
+        return self._queues.items()
+
+
+def _get_site_work_queue_directory(site_manager, create=False):
+    # The directory for the host sites found from *site_manager*.
+    sites = site_manager.getUtility(IEtcNamespace, name='hostsites')
+    main_site_manager = sites.__parent__.getSiteManager()
+    directory = main_site_manager.get(WORK_QUEUE_DIRECTORY_NAME)
+    if directory is None and create:
+        directory = SiteWorkQueueDirectory()
+        main_site_manager[WORK_QUEUE_DIRECTORY_NAME] = directory
+    return directory
+
+
+def install_site_work_queue(site=None):
+    """
+    Install a :class:`SiteWorkQueue` as the :class:`ISiteWorkQueue`
+    utility of the host site *site* (by default, the current site), and
+    return it. If the site already has one, return that instead.
+
+    The queue is also added to the :class:`SiteWorkQueueDirectory`, so
+    that a :class:`SiteWorkQueueConsumer` finds it.
+    """
+    site = getSite() if site is None else site
+    queue = get_site_work_queue(site)
+    if queue is None:
+        queue = SiteWorkQueue()
+        site_manager = site.getSiteManager()
+        install_utility(queue, WORK_QUEUE_NAME, ISiteWorkQueue, site_manager)
+        _get_site_work_queue_directory(site_manager, create=True).add(
+            site.__name__, queue)
+    return queue
+
+
+def get_site_work_queue(site=None):
+    """
+    Return the work queue installed in *site* (by default, the
+    current site), or None.
+
+    Unlike looking up the :class:`ISiteWorkQueue` utility, this does
+    not find the queue of a parent site, whose jobs would be run in
+    the parent site.
+    """
+    site = getSite() if site is None else site
+    return site.getSiteManager().get(WORK_QUEUE_NAME)
+
+
+def _get_pending_jobs(count, site_names=None):
+    # A list of (site name, keys of up to *count* queued jobs) for the
+    # sites with queued jobs. This only loads the directory and the
+    # queues, not the sites.
+    site_manager = component.getSiteManager()
+    directory = _get_site_work_queue_directory(site_manager)
+    if directory is None:
+        return []
+    sites = site_manager.getUtility(IEtcNamespace, name='hostsites')
+    result = []
+    for site_name, queue in directory.items():
+        if site_names is not None and site_name not in site_names:
+            continue
+        if site_name not in sites: # Removed
+            continue
+        keys = queue.peekKeys(count)
+        if keys:
+            result.append((site_name, keys))
+    return result
+
+
+def _run_queued_job(key):
+    # Take the job from the queue and run it. A job that raises an
+    # exception is rolled back but stays taken; a TransientError is
+    # left to the batch runner, which retries and then isolates it.
+    job = get_site_work_queue().pullKey(key)
+    if job is None:
+        # Already taken by someone else.
+        return False
+    savepoint = transaction.savepoint()
+    try:
+        job()
+    except TransientError:
+        raise
+    except Exception: # pylint:disable=broad-except
+        savepoint.rollback()
+        logger.exception("Failed to run queued job %s in site %s",
+                         job, getSite().__name__)
+    return True
+
+
+def _queued_job_failed(key, exception, max_failures):
+    # Called for a job that failed even when run alone. Return whether
+    # it was discarded. A transient failure leaves the job queued for a
+    # later round, until it has failed *max_failures* times.
+    queue = get_site_work_queue()
+    if isinstance(exception, TransientError):
+        failures = queue.recordFailure(key)
+        if failures < max_failures:
+            logger.warning("Queued job %s in site %s failed (%d of %d): %r",
+                           key, getSite().__name__, failures, max_failures,
+                           exception)
+            return False
+    job = queue.pullKey(key)
+    if job is None:
+        return False
+    logger.error("Discarding queued job %s in site %s; it failed alone: %r",
+                 job, getSite().__name__, exception)
+    return True
+
+
+class SiteWorkQueueConsumer(object):
+    """
+    Runs the jobs in the work queues of all host sites.
+
+    Each batch of up to *batch_size* jobs from one site is taken from
+    its queue and run in one transaction, in that site, by
+    :func:`nti.site.runner.run_jobs_in_site_batch` with the given
+    *retries*, *sleep* and *retry_policy*. Each job has a savepoint: a
+    job that raises an exception is logged, rolled back and discarded,
+    while the other jobs of its batch are committed. If the transaction
+    can't be committed, the batch is split until the jobs responsible
+    run alone. A job that still can't be committed by itself because
+    of a :class:`transaction.interfaces.TransientError` (such as a
+    conflict) is left in its queue for a later round; once that has
+    happened *max_failures* times (counted persistently in the queue),
+    or immediately for any other error, it is logged and discarded, so
+    it can't block its queue.
+
+    The sites are served in rounds. Each round, every site with queued
+    jobs gets one batch, so a site with a long queue doesn't delay the
+    others by more than one batch. An error processing one site is
+    logged, and doesn't stop the others.
+    """
+
+    def __init__(self,
+                 batch_size=10,
+                 retries=3,
+                 sleep=None,
+                 retry_policy=None,
+                 root_folder_name=u'nti.dataserver',
+                 max_failures=5):
+        self.batch_size = batch_size
+        self.max_failures = max_failures
+        self._loop_kwargs = dict(
+            retries=retries,
+            sleep=sleep,
+            retry_policy=retry_policy,
+            root_folder_name=root_folder_name,
+        )
+
+    def _get_pending_jobs(self, site_names=None):
+        # Don't conflict with the producers.
+        return run_job_in_site(
+            functools.partial(_get_pending_jobs, self.batch_size, site_names),
+            read_only=True,
+            root_folder_name=self._loop_kwargs['root_folder_name'])
+
+    def process_site(self, site_name, keys=None):
+        """
+        Run one batch of the jobs queued in the host site named
+        *site_name*: those with the given queue *keys*, or by default,
+        those at the front of the queue. Return the number of jobs
+        taken from the queue.
+        """
+        if keys is None:
+            pending = self._get_pending_jobs([site_name])
+            keys = pending[0][1] if pending else ()
+        job_name = 'SiteWorkQueueConsumer %s' % (site_name,)
+        results = run_jobs_in_site_batch(
+            [functools.partial(_run_queued_job, key) for key in keys],
+            batch_size=len(keys) or 1,
+            host_site_name=site_name,
+            job_name=job_name,
+            **self._loop_kwargs)
+        count = sum(1 for result in results if result.result)
+        failed = [functools.partial(_queued_job_failed, key, result.exception,
+                                    self.max_failures)
+                  for key, result in zip(keys, results)
+                  if result.exception is not None]
+        if failed:
+            results = run_jobs_in_site_batch(failed,
+                                             batch_size=len(failed),
+                                             host_site_name=site_name,
+                                             job_name=job_name,
+                                             **self._loop_kwargs)
+            count += sum(1 for result in results if result.result)
+        return count
+
+    def process(self, max_rounds=None):
+        """
+        Run rounds of batches until the queues are empty, until
+        *max_rounds* rounds have been run, or until a round takes no
+        jobs. Return the number of jobs taken from the queues.
+        """
+        count = 0
+        rounds = 0
+        while max_rounds is None or rounds < max_rounds:
+            pending = self._get_pending_jobs()
+            if not pending:
+                break
+            taken = 0
+            for site_name, keys in pending:
+                try:
+                    taken += self.process_site(site_name, keys)
+                except Exception: # pylint:disable=broad-except
+                    logger.exception("Failed to process the work queue of site %s",
+                                     site_name)
+            count += taken
+            rounds += 1
+            if not taken:
+                break
+        return count